@@ -2,13 +2,22 @@ import uvicorn
 import os
 import jsonref
 import json
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.openapi.utils import get_openapi
 from fastapi.encoders import jsonable_encoder
-import motor.motor_asyncio
 from dotenv import load_dotenv
 
+from .responses import ORJSONResponse
+from .compression import CompressionMiddleware
+from .structured_logging import RequestContextMiddleware, setup_logging
+from .timing import ServerTimingMiddleware, report
+
+logger = logging.getLogger(__name__)
+
 description = """
 PatientConnect API helps developers for hospital management
 systems to introduce capability to query and share patient visit data
@@ -31,10 +40,50 @@ Developers will be able to:
 * **Post a patient's current visit**
 """
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from .indexes import ensure_indexes
+    from .users.facility_registry import facility_registry
+    from .patients.visit_cache import visit_cache
+    from .users.password_hashing import password_hasher
+    # records are written by a background thread from here on
+    log_listener = setup_logging()
+    openapi_cache.build(app)
+    await warm_up(db)
+    await ensure_indexes(db)
+    await facility_registry.load(user_routes.facilities_collection)
+    registry_watcher = asyncio.create_task(
+        facility_registry.watch(user_routes.facilities_collection))
+    timing_reporter = asyncio.create_task(
+        report(password_hashing=password_hasher.metrics.snapshot, visit_cache=visit_cache.snapshot))
+    yield
+    for task in (registry_watcher, timing_reporter):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # a task that died earlier must not stop the cleanup below
+            logger.exception("background task failed")
+    password_hasher.shutdown()
+    client.close()
+    log_listener.stop()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# innermost, so its "app" phase leaves out compression
+app.add_middleware(ServerTimingMiddleware)
+# negotiated gzip/brotli/zstd for search results and other large bodies
+app.add_middleware(CompressionMiddleware)
+# outermost, so everything logged while serving a request carries its id
+app.add_middleware(RequestContextMiddleware)
 load_dotenv(os.path.join((os.path.dirname(__file__)), '.env'))
 
-client  = motor.motor_asyncio.AsyncIOMotorClient(os.environ.get("MONGO_URI"))
+from .database import create_client, warm_up
+from . import openapi_cache
+
+# no connection is opened here; the pool is started and closed by lifespan
+client = create_client()
 db = client[str(os.environ.get("DATABASE"))]
 
 from .users import user_routes
@@ -74,3 +123,5 @@ def custom_openapi():
     return app.openapi_schema
 
 app.openapi = custom_openapi
+# /openapi.json serves the schema built once at startup as pre-encoded bytes
+openapi_cache.install(app)
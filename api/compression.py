@@ -0,0 +1,208 @@
+import asyncio
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from dotenv import load_dotenv
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+# bodies smaller than this are sent as they are, compressing them saves nothing
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get("COMPRESSION_MINIMUM_SIZE", 1024))
+# bodies at least this large are compressed in a worker thread
+COMPRESSION_THREAD_MINIMUM_SIZE = int(os.environ.get("COMPRESSION_THREAD_MINIMUM_SIZE", 64 * 1024))
+GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", 5))
+ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", 3))
+# server preference when a client accepts several encodings equally;
+# brotli and zstd are only offered when their package is installed
+COMPRESSION_ENCODINGS = [
+    encoding.strip() for encoding in
+    os.environ.get("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(',') if encoding.strip()]
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+
+def gzip_compressor():
+    # wbits 16 + 15 writes a gzip header and trailer around the deflate stream
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class StreamCompressor:
+    """Incremental gzip, brotli or zstd compressor behind one interface"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._compressor = gzip_compressor()
+        elif encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        elif encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            raise ValueError(f'unsupported encoding {encoding}')
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress a chunk and flush it, so it can be sent right away"""
+        if self.encoding == 'gzip':
+            return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(encoding: str, body: bytes) -> bytes:
+    """Compress a whole body in one go"""
+    if encoding == 'gzip':
+        compressor = gzip_compressor()
+        return compressor.compress(body) + compressor.flush()
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+
+
+def available_encodings() -> list[str]:
+    installed = {'gzip': True, 'br': brotli is not None, 'zstd': zstandard is not None}
+    return [encoding for encoding in COMPRESSION_ENCODINGS if installed.get(encoding)]
+
+
+def negotiate(accept_encoding: str, encodings: list[str]) -> str | None:
+    """Pick the encoding the client rates highest, ties going to the server's
+    order, or None if the client accepts none of them"""
+    ratings = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ratings[coding] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = ratings.get(encoding, ratings.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionMiddleware:
+    """Compress responses with the best encoding the client accepts.
+
+    Responses sent in one piece are compressed whole once they reach
+    COMPRESSION_MINIMUM_SIZE, in a worker thread when they are large, so a
+    long visit history does not stall the event loop. Streamed responses
+    (NDJSON searches) are compressed chunk by chunk and each chunk is flushed,
+    so clients still see visits as they are read. A strong ETag on a
+    compressed response is made weak. Responses that already have a
+    Content-Encoding, like the pre-compressed /openapi.json, are left alone.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE,
+                 thread_minimum_size: int = COMPRESSION_THREAD_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.thread_minimum_size = thread_minimum_size
+        self.encodings = available_encodings()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get('accept-encoding', ''), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await CompressedResponder(self, encoding, send)(scope, receive)
+
+
+class CompressedResponder:
+    """Per-request state of CompressionMiddleware"""
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start_message: Message | None = None
+        self.compressor: StreamCompressor | None = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive):
+        await self.middleware.app(scope, receive, self.send_compressed)
+
+    def compressible(self, headers: Headers) -> bool:
+        if 'content-encoding' in headers:
+            return False
+        if self.start_message['status'] in (204, 304) or self.start_message['status'] < 200:
+            return False
+        return headers.get('content-type', '').startswith(COMPRESSIBLE_TYPES)
+
+    async def send_compressed(self, message: Message):
+        if message['type'] == 'http.response.start':
+            # held back until the first body message shows how to send it
+            self.start_message = message
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self.send(message)
+            return
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start_message['headers'])
+            if not self.compressible(headers) or (not more_body and len(body) < self.middleware.minimum_size):
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            etag = headers.get('etag')
+            if etag is not None and not etag.startswith('W/'):
+                # a strong ETag promises these exact bytes, and the encoded
+                # body differs from the one the route tagged
+                headers['ETag'] = 'W/' + etag
+            if not more_body:
+                if len(body) >= self.middleware.thread_minimum_size:
+                    body = await asyncio.get_running_loop().run_in_executor(
+                        None, compress, self.encoding, body)
+                else:
+                    body = compress(self.encoding, body)
+                headers['Content-Length'] = str(len(body))
+                self.start_message['headers'] = headers.raw
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send({'type': 'http.response.body', 'body': body})
+                return
+            # streamed: the final length is unknown
+            del headers['Content-Length']
+            self.start_message['headers'] = headers.raw
+            self.compressor = StreamCompressor(self.encoding)
+            await self.send(self.start_message)
+
+        chunk = self.compressor.compress(body) if body else b''
+        if not more_body:
+            chunk += self.compressor.finish()
+        await self.send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import os
+
+import motor.motor_asyncio
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+# per worker process; api.server runs one worker per available CPU
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 10))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 300000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000))
+
+logger = logging.getLogger(__name__)
+
+
+def create_client() -> motor.motor_asyncio.AsyncIOMotorClient:
+    """Build the Motor client with pool settings from the environment.
+
+    connect=False means no sockets or monitor threads exist until the first
+    operation, which happens in the worker's lifespan, never in a parent
+    process that may fork.
+    """
+    return motor.motor_asyncio.AsyncIOMotorClient(
+        os.environ.get("MONGO_URI"),
+        connect=False,
+        # datetimes (e.g. visit_datetime) come back as timezone aware UTC
+        tz_aware=True,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    )
+
+
+async def warm_up(db):
+    """Open the minimum pool up front so first requests skip connection setup.
+
+    Concurrent pings each check out their own connection, which fills the pool
+    to minPoolSize now instead of waiting for the background maintenance task.
+    """
+    await asyncio.gather(*(db.command('ping') for _ in range(max(1, MONGO_MIN_POOL_SIZE))))
+    logger.info("mongo pool warmed with %d connections", MONGO_MIN_POOL_SIZE)
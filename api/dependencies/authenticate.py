@@ -10,6 +10,8 @@ from fastapi import Depends, HTTPException, status
 from typing_extensions import Annotated
 from ..app import db
 from ..users.user_models import User
+from ..timing import phase
+from .principal_cache import principal_cache
 
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 
@@ -29,27 +31,34 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 from ..users.user_routes import oauth2_scheme
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # a cached principal was resolved from this exact, still unexpired token
+    cached_user = principal_cache.get(token)
+    if cached_user is not None:
+        return cached_user
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with phase('jwt'):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
     except InvalidTokenError:
         raise credentials_exception
-    user = await users_collection.find_one({'email': email})
+    with phase('user_lookup'):
+        user = await users_collection.find_one(
+            {'email': email}, projection={'_id': 0, 'password': 0})
     if user is None:
         raise credentials_exception
-    del user['_id']
-    del user['password']
-    return user
+    current_user = User(**user)
+    principal_cache.put(token, current_user, payload.get('exp'))
+    return current_user
 
 async def get_current_active_user(
     current_user: Annotated[User, Depends(get_current_user)],
 ):
-    return User(**current_user)
+    return current_user
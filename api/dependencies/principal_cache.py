@@ -0,0 +1,82 @@
+import os
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from ..users.user_models import User
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", 4096))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("PRINCIPAL_CACHE_TTL", 300))
+
+
+class PrincipalCache:
+    """TTL + LRU cache of authenticated users keyed by JWT signature.
+
+    An entry never outlives the token it was resolved from, so an expired
+    token can not be served from the cache, and a hit must match the whole
+    token so a tampered header/payload can not reuse a cached signature.
+    Entries are dropped explicitly through invalidate_user/invalidate_facility
+    when a user record changes.
+    """
+
+    def __init__(self, maxsize: int = PRINCIPAL_CACHE_SIZE, ttl: float = PRINCIPAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, str, User]] = OrderedDict()
+
+    @staticmethod
+    def key_for(token: str) -> str:
+        # the signature segment is unique per issued token
+        return token.rsplit('.', 1)[-1]
+
+    def get(self, token: str) -> User | None:
+        key = self.key_for(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, cached_token, user = entry
+        if cached_token != token:
+            self.misses += 1
+            return None
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return user
+
+    def put(self, token: str, user: User, token_exp: float | None = None):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        key = self.key_for(token)
+        self._entries[key] = (expires_at, token, user)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate_user(self, email: str):
+        """Drop every cached principal for the user with this email"""
+        for key in [k for k, (_, _, u) in self._entries.items() if u.email == email]:
+            del self._entries[key]
+
+    def invalidate_facility(self, facility_name: str):
+        """Drop every cached principal belonging to a facility"""
+        for key in [k for k, (_, _, u) in self._entries.items()
+                    if u.facility_name == facility_name]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+principal_cache = PrincipalCache()
@@ -0,0 +1,112 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+# create missing indexes on startup; set to "false" where a DBA owns the schema
+INDEX_AUTO_CREATE = os.environ.get("INDEX_AUTO_CREATE", "true").lower() == "true"
+# refuse to start when a required index is missing or does not match
+INDEX_STRICT = os.environ.get("INDEX_STRICT", "false").lower() == "true"
+
+logger = logging.getLogger(__name__)
+
+# collections that work without an explicit env var
+COLLECTION_DEFAULTS = {
+    "VISIT_COLLECTION": "visits",
+}
+
+# required indexes per collection, keyed by the env var holding the collection name
+REQUIRED_INDEXES: dict[str, list[IndexModel]] = {
+    "PATIENT_COLLECTION": [
+        # can not be built while the old add_visit's duplicate patients
+        # remain, see api.migrations.merge_duplicate_patients
+        IndexModel([('id_number', ASCENDING)], name='id_number_unique', unique=True),
+        # lets conditional searches read an adult's version from the index
+        # alone; patient_store.patient_version hints it by name
+        IndexModel([('id_number', ASCENDING), ('version', ASCENDING)], name='id_number_version'),
+    ],
+    "USER_COLLECTION": [
+        IndexModel([('email', ASCENDING)], name='email_unique', unique=True),
+        IndexModel([('facility_name', ASCENDING)], name='facility_name_unique', unique=True),
+    ],
+    "FACILITIES_COLLECTION": [
+        IndexModel([('facility_name', ASCENDING)], name='facility_name_unique', unique=True),
+        # covers the registry scans of API workers and import syncs
+        IndexModel([('facility_name', ASCENDING), ('facility_type', ASCENDING),
+                    ('status', ASCENDING)],
+                   name='facility_name_type_status'),
+    ],
+    "VISIT_COLLECTION": [
+        IndexModel([('patient_key', ASCENDING), ('visit_datetime', DESCENDING),
+                    ('_id', DESCENDING)],
+                   name='patient_key_visit_datetime'),
+        IndexModel([('facility_name', ASCENDING)], name='facility_name'),
+        # only visits copied over from embedded arrays carry a legacy_index
+        IndexModel([('legacy_source', ASCENDING), ('legacy_index', ASCENDING)],
+                   name='legacy_source_index',
+                   partialFilterExpression={'legacy_index': {'$exists': True}}),
+    ],
+}
+
+
+def collection_name(env_name: str) -> str | None:
+    return os.environ.get(env_name, COLLECTION_DEFAULTS.get(env_name))
+
+
+def _matches(spec: dict, existing: dict) -> bool:
+    """Compare a declared index against an entry from index_information()"""
+    return (list(spec['key'].items()) == [tuple(k) for k in existing['key']]
+            and spec.get('unique', False) == existing.get('unique', False))
+
+
+async def index_drift(db) -> dict[str, list[str]]:
+    """Return the declared indexes that are missing or differ, per collection"""
+    drift = {}
+    for env_name, models in REQUIRED_INDEXES.items():
+        coll_name = collection_name(env_name)
+        if not coll_name:
+            continue
+        existing = await db[coll_name].index_information()
+        problems = []
+        for model in models:
+            spec = model.document
+            current = existing.get(spec['name'])
+            if current is None:
+                problems.append(f"missing {spec['name']}")
+            elif not _matches(spec, current):
+                problems.append(f"mismatched {spec['name']}")
+        if problems:
+            drift[coll_name] = problems
+    return drift
+
+
+async def ensure_indexes(db) -> dict[str, list[str]]:
+    """Create the declared indexes (idempotent) and report what is still off.
+
+    create_indexes is a no-op for indexes that already exist with the same
+    definition, so this is safe to run on every worker start. Conflicts
+    (e.g. duplicates blocking a unique index) are logged and left as drift.
+    Indexes are created one at a time, so one conflict does not keep the
+    other indexes of the collection from being built.
+    """
+    if INDEX_AUTO_CREATE:
+        for env_name, models in REQUIRED_INDEXES.items():
+            coll_name = collection_name(env_name)
+            if not coll_name:
+                continue
+            for model in models:
+                try:
+                    await db[coll_name].create_indexes([model])
+                except OperationFailure as e:
+                    logger.warning("could not create index %s on %s: %s",
+                                   model.document['name'], coll_name, e)
+    drift = await index_drift(db)
+    for coll_name, problems in drift.items():
+        logger.warning("index drift on %s: %s", coll_name, ', '.join(problems))
+    if drift and INDEX_STRICT:
+        raise RuntimeError(f"Required indexes missing or mismatched: {drift}")
+    return drift
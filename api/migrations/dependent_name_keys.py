@@ -0,0 +1,54 @@
+"""Backfill name_key on dependents stored before it was introduced.
+
+    python -m api.migrations.dependent_name_keys --batch-size 500
+
+Run before serving traffic with the name_key based dependent matching.
+Each patient is only rewritten if its dependents are unchanged since they
+were read, so it is safe to run live.
+"""
+import argparse
+import asyncio
+import os
+
+from pymongo import UpdateOne
+
+from ..app import db
+from ..patients.patient_models import name_key
+
+patients_collection = db[os.environ.get("PATIENT_COLLECTION")]
+
+MISSING_NAME_KEY = {'dependents': {'$elemMatch': {'name_key': {'$exists': False}}}}
+
+
+async def backfill(batch_size: int = 500) -> int:
+    updated = 0
+    while True:
+        # patients whose dependents changed between read and write are left
+        # unmatched and simply come back in a later batch
+        batch = await patients_collection.find(
+            MISSING_NAME_KEY,
+            projection={'dependents': 1}).to_list(batch_size)
+        if not batch:
+            return updated
+        writes = []
+        for patient in batch:
+            dependents = [{**child, 'name_key': name_key(child['name'])}
+                          for child in patient['dependents']]
+            writes.append(UpdateOne(
+                {'_id': patient['_id'], 'dependents': patient['dependents']},
+                {'$set': {'dependents': dependents}}))
+        result = await patients_collection.bulk_write(writes, ordered=False)
+        updated += result.modified_count
+        print(f"backfilled {updated} patients")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='patients read and written per round trip')
+    args = parser.parse_args()
+    print(f"done: {asyncio.run(backfill(args.batch_size))} patients updated")
+
+
+if __name__ == '__main__':
+    main()
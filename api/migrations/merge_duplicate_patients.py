@@ -0,0 +1,79 @@
+"""Merge patient documents that share an id_number into one.
+
+    python -m api.migrations.merge_duplicate_patients
+
+Before add_visit registered patients with upserts, concurrent first visits
+could create several documents for the same id_number, and the
+id_number_unique index can not be built until they are merged. Run this with
+the API stopped, before deploying the version that creates that index, and
+before api.migrations.split_visits.
+
+The oldest document is kept. It gets every embedded visit of the others,
+appended in document order, and their dependents, merged on name_key. Visit
+versions are summed and bumped, so no cached search result or ETag from
+before the merge is reused. The other documents are then deleted.
+"""
+import argparse
+import asyncio
+import os
+
+from ..app import db
+from ..patients.patient_models import name_key
+
+patients_collection = db[os.environ.get("PATIENT_COLLECTION")]
+
+DUPLICATE_ID_NUMBERS = [
+    {'$group': {'_id': '$id_number', 'count': {'$sum': 1}}},
+    {'$match': {'count': {'$gt': 1}}},
+]
+
+
+def merge(patients: list[dict]) -> dict:
+    """The fields to $set on patients[0] so it holds all of their content"""
+    visits = []
+    version = 1
+    dependents: dict[str, dict] = {}
+    for patient in patients:
+        visits.extend(patient.get('visits') or [])
+        version += patient.get('version', 0)
+        for child in patient.get('dependents') or []:
+            key = child.get('name_key') or name_key(child['name'])
+            merged = dependents.get(key)
+            if merged is None:
+                dependents[key] = {**child, 'name_key': key,
+                                   'version': child.get('version', 0) + 1}
+                continue
+            merged['version'] += child.get('version', 0)
+            if child.get('visits'):
+                merged['visits'] = (merged.get('visits') or []) + child['visits']
+    fields = {'version': version, 'dependents': list(dependents.values())}
+    if visits:
+        fields['visits'] = visits
+    return fields
+
+
+async def merge_duplicates() -> dict[str, int]:
+    counts = {'patients': 0, 'removed': 0}
+    async for group in patients_collection.aggregate(DUPLICATE_ID_NUMBERS, allowDiskUse=True):
+        patients = await patients_collection.find(
+            {'id_number': group['_id']}, sort=[('_id', 1)]).to_list(None)
+        if len(patients) < 2:
+            continue
+        keep, duplicates = patients[0], patients[1:]
+        await patients_collection.update_one({'_id': keep['_id']}, {'$set': merge(patients)})
+        result = await patients_collection.delete_many(
+            {'_id': {'$in': [patient['_id'] for patient in duplicates]}})
+        counts['patients'] += 1
+        counts['removed'] += result.deleted_count
+        print(f"merged {counts['patients']} patients, removed {counts['removed']} duplicates")
+    return counts
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__.splitlines()[0]).parse_args()
+    counts = asyncio.run(merge_duplicates())
+    print(f"done: {counts['patients']} patients merged, {counts['removed']} duplicates removed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Move visit histories embedded in patient documents into the visits collection.
+
+Run once after deploying the visits collection, and again until it reports
+nothing left to migrate:
+
+    python -m api.migrations.split_visits --batch-size 200
+
+Each visit is upserted on the array it came from (the patient document and,
+for a dependent, its position) plus its position in that array, so an
+interrupted run can simply be restarted, and two patient documents left with
+the same id_number by the old add_visit can not overwrite each other's
+visits. The embedded arrays are only removed from a patient after all of its
+visits have been written, which also bumps the visit version of the patient
+and their dependents, so searches answered before the migration (an empty
+history) are not served again from caches or with a 304.
+"""
+import argparse
+import asyncio
+import os
+
+from pymongo import ReplaceOne, UpdateMany
+
+from ..app import db
+from ..patients.visit_store import visits_collection, visit_document
+
+patients_collection = db[os.environ.get("PATIENT_COLLECTION")]
+
+EMBEDDED_VISITS = {'$or': [
+    {'visits': {'$exists': True}},
+    {'dependents.visits': {'$exists': True}},
+]}
+
+
+def patient_visit_writes(patient: dict) -> list[ReplaceOne]:
+    """Upserts for every embedded visit of a patient and their dependents"""
+    histories = [(None, None, patient.get('visits') or [])]
+    for child_index, child in enumerate(patient.get('dependents') or []):
+        histories.append((child_index, child['name'], child.get('visits') or []))
+    writes = []
+    for child_index, child_name, visits in histories:
+        source = {'_id': patient['_id'], 'child': child_index}
+        for index, visit in enumerate(visits):
+            document = visit_document(visit, patient['id_number'], child_name)
+            document['legacy_source'] = source
+            document['legacy_index'] = index
+            # embedded visits were never checked against the current model, so
+            # they are validated on read rather than trusted
+            del document['schema_version']
+            writes.append(ReplaceOne(
+                {'legacy_source': source, 'legacy_index': index},
+                document, upsert=True))
+    return writes
+
+
+async def migrate(batch_size: int = 200) -> dict[str, int]:
+    counts = {'patients': 0, 'visits': 0}
+    while True:
+        batch = await patients_collection.find(EMBEDDED_VISITS).to_list(batch_size)
+        if not batch:
+            return counts
+        writes = []
+        for patient in batch:
+            writes.extend(patient_visit_writes(patient))
+        if writes:
+            await visits_collection.bulk_write(writes, ordered=False)
+        ids = [patient['_id'] for patient in batch]
+        await patients_collection.bulk_write([
+            UpdateMany({'_id': {'$in': ids}},
+                       {'$unset': {'visits': ''}, '$inc': {'version': 1}}),
+            # $[] needs the array to exist
+            UpdateMany({'_id': {'$in': ids}, 'dependents': {'$type': 'array'}},
+                       {'$unset': {'dependents.$[].visits': ''},
+                        '$inc': {'dependents.$[].version': 1}}),
+        ])
+        counts['patients'] += len(batch)
+        counts['visits'] += len(writes)
+        print(f"migrated {counts['patients']} patients, {counts['visits']} visits")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=200,
+                        help='patients read and written per round trip')
+    args = parser.parse_args()
+    counts = asyncio.run(migrate(args.batch_size))
+    print(f"done: {counts['patients']} patients, {counts['visits']} visits")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Backfill visit_datetime from the visit_date string on visits missing it.
+
+    python -m api.migrations.visit_datetimes --batch-size 1000
+
+Visits whose visit_date can not be parsed are left with a null
+visit_datetime and counted; they sort after dated visits. The visit version
+of every patient with an updated visit, and of their dependents, is bumped,
+so cached histories and ETags from before are not reused.
+"""
+import argparse
+import asyncio
+import os
+
+from pymongo import UpdateMany, UpdateOne
+
+from ..app import db
+from ..patients.visit_store import visits_collection, parse_visit_date
+
+patients_collection = db[os.environ.get("PATIENT_COLLECTION")]
+
+
+def version_bumps(id_numbers: list[int]) -> list[UpdateMany]:
+    return [
+        UpdateMany({'id_number': {'$in': id_numbers}}, {'$inc': {'version': 1}}),
+        # $[] needs the array to exist
+        UpdateMany({'id_number': {'$in': id_numbers}, 'dependents': {'$type': 'array'}},
+                   {'$inc': {'dependents.$[].version': 1}}),
+    ]
+
+
+async def backfill(batch_size: int = 1000) -> dict[str, int]:
+    counts = {'updated': 0, 'unparsed': 0}
+    last_id = None
+    while True:
+        query = {'visit_datetime': None}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = await visits_collection.find(
+            query, projection={'visit_date': 1, 'id_number': 1},
+            sort=[('_id', 1)]).to_list(batch_size)
+        if not batch:
+            return counts
+        last_id = batch[-1]['_id']
+        writes = []
+        id_numbers = set()
+        for visit in batch:
+            visit_datetime = parse_visit_date(visit.get('visit_date'))
+            if visit_datetime is None:
+                counts['unparsed'] += 1
+                continue
+            writes.append(UpdateOne({'_id': visit['_id'], 'visit_datetime': None},
+                                    {'$set': {'visit_datetime': visit_datetime}}))
+            id_numbers.add(visit['id_number'])
+        if writes:
+            result = await visits_collection.bulk_write(writes, ordered=False)
+            counts['updated'] += result.modified_count
+            await patients_collection.bulk_write(version_bumps(sorted(id_numbers)))
+        print(f"updated {counts['updated']} visits, {counts['unparsed']} unparsed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='visits read and written per round trip')
+    args = parser.parse_args()
+    counts = asyncio.run(backfill(args.batch_size))
+    print(f"done: {counts['updated']} updated, {counts['unparsed']} unparsed")
+
+
+if __name__ == '__main__':
+    main()
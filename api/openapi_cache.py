@@ -0,0 +1,69 @@
+import gzip
+import hashlib
+import json
+import os
+
+from fastapi import FastAPI, Request, Response
+from starlette.routing import Route
+
+from dotenv import load_dotenv
+
+from .compression import negotiate
+from .responses import etag_matches
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+# serve a schema generated ahead of time (python -m api.openapi_cache FILE)
+OPENAPI_SCHEMA_FILE = os.environ.get("OPENAPI_SCHEMA_FILE")
+
+
+class OpenAPIDocument:
+    """The OpenAPI schema encoded once, plus a gzip copy and an ETag"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=9)
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+    @classmethod
+    def from_schema(cls, schema: dict):
+        return cls(json.dumps(schema, separators=(',', ':')).encode('utf-8'))
+
+    def response(self, request: Request) -> Response:
+        headers = {'ETag': self.etag, 'Vary': 'Accept-Encoding',
+                   'Cache-Control': 'public, max-age=0, must-revalidate'}
+        if etag_matches(request.headers.get('if-none-match'), self.etag):
+            return Response(status_code=304, headers=headers)
+        if negotiate(request.headers.get('accept-encoding', ''), ['gzip']):
+            headers['Content-Encoding'] = 'gzip'
+            headers['ETag'] = 'W/' + self.etag
+            return Response(self.gzip_body, media_type='application/json', headers=headers)
+        return Response(self.body, media_type='application/json', headers=headers)
+
+
+def install(app: FastAPI):
+    """Replace FastAPI's /openapi.json route with one serving app.state.openapi_document"""
+    app.router.routes = [
+        route for route in app.router.routes
+        if not (isinstance(route, Route) and route.path == app.openapi_url)]
+
+    async def openapi(request: Request) -> Response:
+        return request.app.state.openapi_document.response(request)
+
+    app.add_route(app.openapi_url, openapi, include_in_schema=False)
+
+
+def build(app: FastAPI):
+    """Generate (or load) the schema once per worker, before serving requests"""
+    if OPENAPI_SCHEMA_FILE:
+        with open(OPENAPI_SCHEMA_FILE, 'rb') as f:
+            app.state.openapi_document = OpenAPIDocument(f.read())
+    else:
+        app.state.openapi_document = OpenAPIDocument.from_schema(app.openapi())
+
+
+if __name__ == '__main__':
+    import sys
+    from .app import app
+    with open(sys.argv[1], 'wb') as f:
+        f.write(OpenAPIDocument.from_schema(app.openapi()).body)
@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+from typing import AsyncIterator
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ..users.user_models import User
+from .patient_models import VisitUpload
+from .patient_store import visit_writes
+from .visit_cache import visit_cache
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 500))
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", 10000))
+# a JSON array body is decoded whole, so its size is capped
+BULK_MAX_BODY_BYTES = int(os.environ.get("BULK_MAX_BODY_BYTES", 32 * 1024 * 1024))
+# longest single visit accepted in an NDJSON stream
+BULK_MAX_LINE_BYTES = int(os.environ.get("BULK_MAX_LINE_BYTES", 1024 * 1024))
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+logger = logging.getLogger(__name__)
+
+
+class BatchLimitReached(Exception):
+    """Yielded in place of the first NDJSON visit past BULK_MAX_ITEMS"""
+
+
+async def read_uploads(request: Request) -> AsyncIterator[tuple[int, object]]:
+    """Yield (index, raw item) from a JSON array body or an NDJSON stream.
+
+    NDJSON is decoded line by line as it arrives, so a large upload is never
+    held in memory as a whole. Lines that are not valid JSON are yielded as
+    the exception so they show up in the per-item results. Reading an NDJSON
+    stream stops at its first visit past BULK_MAX_ITEMS, which is yielded as
+    a BatchLimitReached, since the visits before it may already be stored.
+    Arrays of more than BULK_MAX_ITEMS visits, lines longer than
+    BULK_MAX_LINE_BYTES and array bodies larger than BULK_MAX_BODY_BYTES are
+    rejected with a 413.
+    """
+    limit_reached = BatchLimitReached(
+        f'At most {BULK_MAX_ITEMS} visits per request; this visit and the ones '
+        f'after it were not read')
+
+    def too_large(limit: int, what: str):
+        return HTTPException(status_code=413, detail=f'{what} larger than {limit} bytes')
+
+    if NDJSON_MEDIA_TYPE in request.headers.get('content-type', ''):
+        # pieces of the line still being received; only they are kept
+        tail, tail_size = [], 0
+        count = 0
+        async for chunk in request.stream():
+            *lines, rest = chunk.split(b'\n')
+            if lines:
+                lines[0] = b''.join(tail) + lines[0]
+                tail, tail_size = [], 0
+            tail.append(rest)
+            tail_size += len(rest)
+            if tail_size > BULK_MAX_LINE_BYTES:
+                raise too_large(BULK_MAX_LINE_BYTES, 'Visit line')
+            for line in lines:
+                if len(line) > BULK_MAX_LINE_BYTES:
+                    raise too_large(BULK_MAX_LINE_BYTES, 'Visit line')
+                if not line.strip():
+                    continue
+                if count >= BULK_MAX_ITEMS:
+                    yield count, limit_reached
+                    return
+                yield count, _loads(line)
+                count += 1
+        line = b''.join(tail)
+        if line.strip():
+            yield count, limit_reached if count >= BULK_MAX_ITEMS else _loads(line)
+        return
+
+    if int(request.headers.get('content-length') or 0) > BULK_MAX_BODY_BYTES:
+        raise too_large(BULK_MAX_BODY_BYTES, 'Body')
+    body, body_size = [], 0
+    async for chunk in request.stream():
+        body_size += len(chunk)
+        if body_size > BULK_MAX_BODY_BYTES:
+            raise too_large(BULK_MAX_BODY_BYTES, 'Body')
+        body.append(chunk)
+    try:
+        items = json.loads(b''.join(body))
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Body must be a JSON array of visits')
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail='Body must be a JSON array of visits')
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f'At most {BULK_MAX_ITEMS} visits per request')
+    for index, item in enumerate(items):
+        yield index, item
+
+
+def _loads(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+
+class BulkVisitIngest:
+    """Validate uploaded visits and write them in unordered bulk batches.
+
+    Items are buffered until chunk_size is reached. Each flush sends one
+    bulk_write inserting the visits, then one bulk_write with a single upsert
+    per distinct patient in the chunk that got a visit, which registers them
+    and bumps their version (see patient_store.visit_writes).
+    """
+
+    def __init__(self, patients_collection, visits_collection, user: User,
+                 chunk_size: int = BULK_CHUNK_SIZE):
+        self.patients_collection = patients_collection
+        self.visits_collection = visits_collection
+        self.user = user
+        self.chunk_size = chunk_size
+        self.results: dict[int, dict] = {}
+        self._pending: list[tuple[int, dict, dict | list, dict]] = []
+
+    def _fail(self, index: int, detail):
+        self.results[index] = {'index': index, 'status': 'error', 'detail': detail}
+
+    async def add(self, index: int, raw):
+        if isinstance(raw, BatchLimitReached):
+            self._fail(index, str(raw))
+            return
+        if isinstance(raw, Exception):
+            self._fail(index, f'Invalid JSON: {raw}')
+            return
+        try:
+            visit = VisitUpload.model_validate(raw)
+        except ValidationError as e:
+            self._fail(index, e.errors(include_url=False, include_context=False))
+            return
+        self._pending.append((index, *visit_writes(visit, self.user)))
+        if len(self._pending) >= self.chunk_size:
+            await self.flush()
+
+    async def flush(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        failed = set()
+        try:
+            await self.visits_collection.bulk_write(
+                [InsertOne(document) for _, _, _, document in pending], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                index = pending[error['index']][0]
+                failed.add(index)
+                self._fail(index, error['errmsg'])
+
+        # once its visits are stored, one upsert per patient (or dependent)
+        # registers them and bumps their version, however many visits they have
+        groups: dict[str, list[tuple[int, dict]]] = {}
+        patient_ops = []
+        for index, patient_filter, patient_update, document in pending:
+            if index in failed:
+                continue
+            key = document['patient_key']
+            if key not in groups:
+                groups[key] = []
+                patient_ops.append((key, UpdateOne(patient_filter, patient_update, upsert=True)))
+            groups[key].append((index, document))
+        if not patient_ops:
+            return
+        failed_keys = set()
+        try:
+            await self.patients_collection.bulk_write(
+                [op for _, op in patient_ops], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                key = patient_ops[error['index']][0]
+                failed_keys.add(key)
+                for index, _ in groups[key]:
+                    self._fail(index, error['errmsg'])
+        if failed_keys:
+            # take the visits back, so retrying the failed items does not
+            # store them twice
+            await self.visits_collection.delete_many({'_id': {'$in': [
+                document['_id'] for key in failed_keys for _, document in groups[key]]}})
+        for key, visits in groups.items():
+            if key not in failed_keys:
+                for index, _ in visits:
+                    self.results[index] = {'index': index, 'status': 'ok'}
+            visit_cache.invalidate(key)
+
+    def summary(self) -> dict:
+        results = [self.results[index] for index in sorted(self.results)]
+        inserted = sum(1 for result in results if result['status'] == 'ok')
+        return {'inserted': inserted, 'failed': len(results) - inserted, 'results': results}
@@ -1,8 +1,10 @@
-from pydantic import BaseModel, ConfigDict, field_serializer, EmailStr, Field, field_validator
+from pydantic import BaseModel, ConfigDict, field_serializer, EmailStr, Field, field_validator, model_validator
 from pydantic.functional_validators import BeforeValidator
 from typing_extensions import Annotated, Literal
 from typing import List, Optional
 from decimal import Decimal
+from datetime import datetime
+import os
 
 from bson import ObjectId
 
@@ -10,6 +12,14 @@ import email_validator
 
 email_validator.TEST_ENVIRONMENT = True
 
+VISIT_PAGE_MAX_LIMIT = int(os.environ.get("VISIT_PAGE_MAX_LIMIT", 100))
+
+def name_key(name: str) -> str:
+    """Canonical, order and case insensitive form of a person's name,
+    e.g. "John Doe" and "doe john" both become "doe john"
+    """
+    return ' '.join(sorted(set(part.lower() for part in name.split())))
+
 # Represents an ObjectId field in the database.
 # It will be represented as a `str` on the model so that it can be serialized to JSON.
 PyObjectId = Annotated[str, BeforeValidator(str)]
@@ -106,6 +116,7 @@ class VisitDetails(BaseModel):
     facility_name: Optional[str] = None
     facility_type: Optional[str] = None
     visit_date: Optional[str] = None
+    visit_datetime: Optional[datetime] = None
     patient_bio: PatientBio
     visit_vitals: PatientVitals
     visit_clinical_notes: str
@@ -121,6 +132,7 @@ class VisitDetails(BaseModel):
             "example": {
                 "facility_name": "Test Hospital",
                 "visit_date": "Tue 16 Jul 2024, 03:51PM",
+                "visit_datetime": "2024-07-16T15:51:00Z",
                 "patient_bio": {
                     "name": "Jane Doe",
                     "age": 0.1,
@@ -165,6 +177,36 @@ class VisitResponse(BaseModel):
   """
   visits: List[VisitDetails | None]
 
+class VisitPageSearch(VisitSearch):
+    """
+    Model for requesting one page of a patient's visits, newest first
+    """
+    limit: int = Field(default=20, gt=0, le=VISIT_PAGE_MAX_LIMIT)
+    cursor: Optional[str] = None
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+
+    model_config = ConfigDict(
+        populate_by_name=True,
+        arbitrary_types_allowed=True,
+        json_schema_extra={
+            "example": {
+                "id_number": 12341234,
+                "name": "John doe",
+                "is_child": "false",
+                "limit": 20,
+                "since": "2024-01-01T00:00:00Z"
+            }
+        },
+    )
+
+class VisitPage(BaseModel):
+  """
+  Model to set response validation for /patients/search/page route
+  """
+  visits: List[VisitDetails]
+  next_cursor: Optional[str] = None
+
 class VisitUpload(BaseModel):
     """
     Model to validate data posted to the  patients/visit route
@@ -174,31 +216,37 @@ class VisitUpload(BaseModel):
 
 class Child(BaseModel):
     """
-    Model to represent pediatric patients
+    Model to represent pediatric patients.
+    Visits are stored in the visits collection, see visit_store
     """
     name: str
-    visits: Optional[List[VisitDetails]] = []
+    name_key: Optional[str] = None
+
+    # dependents are matched on name_key, so it is always derived from name
+    @model_validator(mode='after')
+    def set_name_key(self):
+        self.name_key = name_key(self.name)
+        return self
 
     model_config = ConfigDict(
         populate_by_name=True,
         arbitrary_types_allowed=True,
         json_schema_extra={
             "example": {
-                "name": "John doe",
-                "visits": []
+                "name": "John doe"
             }
         },
     )
 
 class Patient(BaseModel):
     """
-    Model to represent an adult patient
+    Model to represent an adult patient.
+    Visits are stored in the visits collection, see visit_store
     """
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
     id_number: int
     name: str
     dependents: Optional[List[Child]] = []
-    visits: Optional[List[VisitDetails]] = []
 
     model_config = ConfigDict(
         populate_by_name=True,
@@ -207,8 +255,7 @@ class Patient(BaseModel):
             "example": {
                 "id_number": 1234124,
                 "name": "John doe",
-                "dependents": [],
-                "visits": []
+                "dependents": []
             }
         },
     )
@@ -1,13 +1,23 @@
 from typing import Annotated, List
 
-from fastapi import Body, Depends, APIRouter
+from fastapi import Body, Depends, APIRouter, HTTPException, Header, Request, Response
+from fastapi.responses import StreamingResponse
+import logging
 import os
-from datetime import datetime, timezone
 from dotenv import load_dotenv
+from pymongo.errors import PyMongoError
 
 from ..app import db
-from .patient_models import Patient, Child, VisitSearch,\
-    VisitUpload, VisitDetails, VisitResponse
+from ..responses import dumps, etag_matches
+from ..timing import phase
+from .patient_models import VisitSearch, name_key,\
+    VisitUpload, VisitDetails, VisitResponse, VisitPageSearch, VisitPage
+from .visit_store import visits_collection, patient_key,\
+    visit_page_filter, encode_cursor, visits_response, strip_schema_versions,\
+    search_etag, VISIT_PROJECTION, VISIT_PAGE_SORT
+from .visit_cache import visit_cache, VISIT_CACHE_MAX_VISITS
+from .patient_store import visit_writes, patient_version
+from .bulk_ingest import BulkVisitIngest, read_uploads, NDJSON_MEDIA_TYPE
 from ..users.user_models import User
 
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
@@ -16,6 +26,9 @@ SECRET_KEY = os.environ.get("SECRET_KEY")
 ALGORITHM = os.environ.get("ALGORITHM")
 patient_router = APIRouter()
 patients_collection = db[os.environ.get("PATIENT_COLLECTION")]
+STREAM_BATCH_SIZE = int(os.environ.get("VISIT_STREAM_BATCH_SIZE", 100))
+
+logger = logging.getLogger(__name__)
 
 from ..dependencies.authenticate import get_current_active_user
 
@@ -24,9 +37,15 @@ from ..dependencies.authenticate import get_current_active_user
     response_model=VisitResponse)
 async def get_patient(
         current_user: Annotated[User, Depends(get_current_active_user)],
-        patient: VisitSearch = Body(...),) -> dict[str, List[VisitDetails]]:
+        patient: VisitSearch = Body(...),
+        accept: Annotated[str | None, Header()] = None,
+        if_none_match: Annotated[str | None, Header()] = None,) -> dict[str, List[VisitDetails]]:
     """Search for patient in the database to get previous visits.
     Previous visits posted by the current facility will not be shown
+    Send an "Accept: application/x-ndjson" header to receive the visits
+    streamed as one JSON object per line instead of a single "visits" array.
+    Every response carries an ETag; send it back in an "If-None-Match" header
+    to get an empty 304 Not Modified if no visit was posted since.
     You need to supply the following details:
 
         "visit_search": {
@@ -43,6 +62,7 @@ async def get_patient(
             {
                 "facility_name": STRING ("facility the patient visited"),
                 "visit_date": STRING,
+                "visit_datetime": DATETIME (ISO 8601, UTC) or null for some older visits,
                 "patient_bio": {
                     "age": FLOAT,
                     "gender": STRING ("male" or "female"),
@@ -60,7 +80,8 @@ async def get_patient(
             }
         Note:
             facility_name is the facility tied to the visit
-            visit_date is derived from naive datetime object with strftime format: "%a %d %b %Y, %I:%M%p"
+            visit_datetime is the time the visit was posted, in UTC
+            visit_date is visit_datetime in server local time with strftime format: "%a %d %b %Y, %I:%M%p"
 
         Details of Optional fields:
             visit_investigations:
@@ -82,34 +103,117 @@ async def get_patient(
                     medication_duration: INTEGER - Duration of medication prescription (e.g., number of days).
                     medication_instructions: STRING (Optional) - Special instructions for taking the medication.
         """
-    if patient.is_child:
-        patient_db = await patients_collection.find_one(
-            filter={'id_number': patient.id_number},
-            projection={'dependents': 1, '_id': 0})
-        if patient_db is not None:
-            for child in patient_db['dependents']:
-                name1_parts = set(name.lower() for name in child['name'].split())
-                name2_parts = set(name.lower() for name in patient.name.split())
-                if name1_parts == name2_parts:
-                    other_facility_visits = []
-                    for visit in child['visits']:
-                        if visit['facility_name'] != current_user.facility_name:
-                            other_facility_visits.append(visit)
-                    print('visits for a child retrived')
-                    return {'visits': other_facility_visits}
+    # visits of a child are keyed by the parent's id_number plus the child's name
+    key = patient_key(patient.id_number, patient.name if patient.is_child else None)
+    # visits posted by the current facility are dropped by the server
+    visit_filter = {'patient_key': key,
+                    'facility_name': {'$ne': current_user.facility_name}}
+    visit_sort = [('visit_datetime', 1), ('_id', 1)]
+    # the version is bumped after every visit is stored, so it is read first:
+    # visits read after it are at least as new as the ETag claims
+    with phase('version'):
+        version = await patient_version(
+            patients_collection, patient.id_number, name_key(patient.name) if patient.is_child else None)
+    # the representation is picked first, the two must not share an ETag
+    media_type = NDJSON_MEDIA_TYPE if accept is not None and NDJSON_MEDIA_TYPE in accept \
+        else 'application/json'
+    etag = search_etag(key, current_user.facility_name, version, media_type)
+    headers = {'ETag': etag, 'Vary': 'Accept'}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if media_type == NDJSON_MEDIA_TYPE:
+        cursor = visits_collection.find(
+            filter=visit_filter, projection=VISIT_PROJECTION, sort=visit_sort)
+        return StreamingResponse(
+            stream_visits(cursor.batch_size(STREAM_BATCH_SIZE)),
+            media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    # schema_version is kept so that canonical visits can skip re-validation
+    projection = {**VISIT_PROJECTION}
+    del projection['schema_version']
+
+    cached = visit_cache.get(key, version)
+    if cached is not None:
+        visits, trusted = cached.visits, cached.trusted
     else:
-        patient_db = await patients_collection.find_one(
-            filter={'id_number': patient.id_number},
-            projection={'visits': 1, '_id': 0})
-        other_facility_visits = []
-        if patient_db is not None:
-            for visit in patient_db['visits']:
-                if visit['facility_name'] != current_user.facility_name:
-                    other_facility_visits.append(visit)
-            print('visits for an adult retrieved')
-            return {'visits': other_facility_visits}
-    print('visits for a non existent patient')
-    return {'visits': []}
+        with phase('find'):
+            # the whole history is cached once and shared by every facility;
+            # reading one visit past the limit tells whether it fits
+            visits = await visits_collection.find(
+                filter={'patient_key': key}, projection=projection, sort=visit_sort,
+                limit=VISIT_CACHE_MAX_VISITS + 1).to_list(None)
+            cacheable = len(visits) <= VISIT_CACHE_MAX_VISITS
+            if not cacheable:
+                # a history too long to cache is read again without this
+                # facility's visits, which the server leaves out
+                visits = await visits_collection.find(
+                    filter=visit_filter, projection=projection, sort=visit_sort).to_list(None)
+        trusted = strip_schema_versions(visits)
+        if cacheable:
+            visit_cache.put(key, version, visits, trusted)
+    with phase('filter'):
+        other_facility_visits = [visit for visit in visits
+                                 if visit['facility_name'] != current_user.facility_name]
+    logger.info("visits retrieved", extra={
+        'patient': 'child' if patient.is_child else 'adult',
+        'visits': len(other_facility_visits), 'cached': cached is not None})
+    with phase('encode'):
+        response = visits_response({'visits': other_facility_visits}, VisitResponse, trusted)
+    response.headers.update(headers)
+    return response
+
+
+async def stream_visits(cursor):
+    """Encode visits one line at a time as the cursor yields them, so only
+    one driver batch is held in memory however long the history is"""
+    async for visit in cursor:
+        yield dumps(visit) + b'\n'
+
+
+@patient_router.post('/patients/search/page',
+    summary="Search for a page of a patient's previous visits, newest first",
+    response_model=VisitPage)
+async def get_patient_page(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+        patient: VisitPageSearch = Body(...),) -> dict:
+    """Search for a patient's previous visits one page at a time.
+    Previous visits posted by the current facility will not be shown
+    You need to supply the same details as /patients/search plus:
+
+        "limit": INTEGER (Optional, visits per page, default 20),
+        "cursor": STRING (Optional, next_cursor from the previous page),
+        "since": DATETIME (Optional, only visits at or after this time),
+        "until": DATETIME (Optional, only visits before this time)
+
+    Returns:
+
+        {
+            "visits": ARRAY of visit details objects, newest first (see /patients/search),
+            "next_cursor": STRING to fetch the next page, or null on the last page
+        }
+    """
+    key = patient_key(patient.id_number, patient.name if patient.is_child else None)
+    try:
+        page_filter = visit_page_filter(
+            key, current_user.facility_name,
+            since=patient.since, until=patient.until, cursor=patient.cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    projection = {**VISIT_PROJECTION}
+    del projection['_id'], projection['schema_version']
+    # one extra visit tells us whether another page exists
+    with phase('find'):
+        visits = await visits_collection.find(
+            filter=page_filter,
+            projection=projection,
+            sort=VISIT_PAGE_SORT).to_list(patient.limit + 1)
+    next_cursor = None
+    if len(visits) > patient.limit:
+        visits = visits[:patient.limit]
+        next_cursor = encode_cursor(visits[-1])
+    for visit in visits:
+        del visit['_id']
+    with phase('encode'):
+        return visits_response({'visits': visits, 'next_cursor': next_cursor}, VisitPage)
 
 
 @patient_router.post('/patients/visit',
@@ -184,82 +288,60 @@ async def add_visit(
             Message: description of the issue.
     """
 
-    patient = visit.patient_search
-    visit_details = visit.visit_details
-    visit_details.facility_name = current_user.facility_name
-    visit_details.facility_type = current_user.facility_type
-    visit_details.visit_date = datetime.now().strftime("%a %d %b %Y, %I:%M%p") 
-
-    if patient.is_child:
-        update_child = False
-        parent_db = await patients_collection.find_one(
-            filter={'id_number': patient.id_number},
-            projection={'id_number': 1, '_id': 0})
-        # check if parent exists in the database, if not add them plus child
-        if not parent_db:
-            child = Child(name=patient.name,
-                          visits=[visit_details])
-            parent = Patient(
-                id_number=patient.id_number,
-                name=patient.parent_name,
-                dependents=[child]
-                )
-            await patients_collection.insert_one(parent.model_dump())
-            print("inserted new child and parent")
-            update_child = True
-        else:
-        #parent is in the database
-            parent_dependents= await patients_collection.find_one(
-            filter={'id_number': patient.id_number},
-            projection={'dependents': 1, '_id': 0})
-            #check if there are any dependents,if not create a new Child and add them
-            if len(parent_dependents['dependents']) == 0:
-                child = Child(name=patient.name,
-                          visits=[visit_details])
-                await patients_collection.update_one(
-                    filter={'id_number': patient.id_number},
-                    update={ '$push': { 'dependents': child.model_dump() } }
-                )
-                print("inserted new child for parents with no dependents")
-                update_child = True
-            else:
-                # if dependant available, find the correct one and update their visits array
-                for child in parent_dependents['dependents']:
-                    name1_parts = set(name.lower() for name in child['name'].split())
-                    name2_parts = set(name.lower() for name in patient.name.split())
-                    if name1_parts == name2_parts:
-                        await patients_collection.update_one(
-                            filter={'id_number': patient.id_number, 'dependents.name': child['name']},
-                            update={ '$push': {
-                                'dependents.$.visits': visit_details.model_dump()}})
-                        print("updated old child visit records")
-                        update_child = True
-                        break
-        # if parent exists and child is new, add a new child
-        if not update_child:
-            child =  Child(name=patient.name,
-                           visits=[visit_details])
-            await patients_collection.update_one(
-                            filter={'id_number': patient.id_number},
-                            update={ '$push': {
-                                'dependents': child.model_dump()}})
-            print("inserted a new child to a parent with children")
-    else:
-        # update details for an adult patient
-        patient_db = await patients_collection.find_one(
-            filter={'id_number': patient.id_number},
-            projection={'id_number': 1, '_id': 0})
-        # check if patient exists in the database, if not add them
-        if not patient_db:
-            patient = Patient(name=patient.name,
-                              id_number=patient.id_number,
-                              visits=[visit_details])
-            await patients_collection.insert_one(patient.model_dump())
-            print("inserted new parent without children")
-        else:
-            await patients_collection.update_one(
-                filter={'id_number': patient.id_number},
-                update={ '$push': {
-                                'visits': visit_details.model_dump()}})
-            print("updated old parent without children")
+    patient_filter, patient_update, document = visit_writes(visit, current_user)
+    # the two writes are not one transaction: the upsert registers the patient
+    # and bumps their version once the visit is stored (see visit_writes), and
+    # the visit is taken back if it fails, so the client's retry does not
+    # store it twice
+    with phase('write'):
+        await visits_collection.insert_one(document)
+        try:
+            await patients_collection.update_one(patient_filter, patient_update, upsert=True)
+        except PyMongoError:
+            await visits_collection.delete_one({'_id': document['_id']})
+            raise
+    visit_cache.invalidate(document['patient_key'])
+    logger.info("visit posted", extra={
+        'patient': 'child' if visit.patient_search.is_child else 'adult'})
     return {'status': 'Visit posted successfully'}
+
+
+@patient_router.post('/patients/visits/bulk',
+    summary="Post many patient visits in one request")
+async def add_visits_bulk(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+        request: Request,):
+    """
+    Post a batch of patient visits, e.g. an end of shift upload from a HMS.
+    The body is either a JSON array of visit objects, or a stream of visit
+    objects one per line with a "Content-Type: application/x-ndjson" header.
+    Each visit object has the same format as the body of /patients/visit.
+
+    Visits are validated one by one, so a bad record does not reject the
+    whole batch, and are written in chunks.
+
+    Returns:
+
+        Success:
+            StatusCode: 200
+            Message: {
+                "inserted": INTEGER,
+                "failed": INTEGER,
+                "results": ARRAY of {"index": INTEGER, "status": "ok" or "error", "detail": (only on error)}
+            }
+            index is the position of the visit in the uploaded batch
+        Failure:
+            StatusCode: 400 if the body is not a JSON array, 413 if a JSON array has too
+            many visits, the body or a single NDJSON line is too large
+            (for NDJSON streams, chunks before the line was read are already posted)
+        An NDJSON stream with too many visits is read up to the limit and the
+        visits before it are posted; the first visit past the limit is reported
+        as an error in results, and it and every later line were not read
+    """
+    ingest = BulkVisitIngest(patients_collection, visits_collection, current_user)
+    async for index, raw in read_uploads(request):
+        await ingest.add(index, raw)
+    await ingest.flush()
+    summary = ingest.summary()
+    logger.info("bulk upload", extra={'inserted': summary['inserted'], 'failed': summary['failed']})
+    return summary
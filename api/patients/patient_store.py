@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+
+from ..users.user_models import User
+from .patient_models import Child, VisitUpload
+from .visit_store import visit_document, VISIT_DATE_FORMAT
+
+
+def adult_upsert(id_number: int, name: str) -> tuple[dict, dict]:
+    """Filter and update that register an adult patient if they are new and
+    increment their visit version.
+
+    With the unique index on id_number, concurrent upserts for the same
+    patient can not create duplicates: the server retries the loser as an
+    update. It only does so when the update leaves the filter's fields
+    alone, so id_number is left to the upsert, which copies it from the
+    filter.
+    """
+    return (
+        {'id_number': id_number},
+        {'$setOnInsert': {'name': name, 'dependents': []}, '$inc': {'version': 1}},
+    )
+
+
+def child_upsert(id_number: int, parent_name: str, child_name: str) -> tuple[dict, list]:
+    """Filter and pipeline update that register a parent and/or dependent
+    and increment the dependent's visit version.
+
+    The parent is created if missing and the child is appended to dependents
+    only when no dependent has the same name_key, all in one atomic document
+    update. As in adult_upsert, id_number is not set by the update.
+    """
+    child = Child(name=child_name).model_dump()
+    dependents = {'$ifNull': ['$dependents', []]}
+    is_child = {'$eq': ['$$child.name_key', {'$literal': child['name_key']}]}
+    has_child = {'$in': [{'$literal': child['name_key']},
+                         {'$ifNull': ['$dependents.name_key', []]}]}
+    bumped = {'$map': {'input': dependents, 'as': 'child', 'in': {'$cond': [
+        is_child,
+        {'$mergeObjects': ['$$child', {'version': {'$add': [{'$ifNull': ['$$child.version', 0]}, 1]}}]},
+        '$$child',
+    ]}}}
+    return (
+        {'id_number': id_number},
+        [{'$set': {
+            'name': {'$ifNull': ['$name', {'$literal': parent_name}]},
+            'dependents': {'$cond': [
+                has_child,
+                bumped,
+                {'$concatArrays': [dependents, [{'$literal': {**child, 'version': 1}}]]},
+            ]},
+        }}],
+    )
+
+
+def visit_writes(visit: VisitUpload, user: User,
+                 visit_datetime: datetime | None = None) -> tuple[dict, dict | list, dict]:
+    """Stamp a posted visit with the posting facility and time, and return the
+    patient upsert (filter, update) plus the visit document to insert.
+
+    The upsert also bumps the patient's visit version, so it is issued only
+    after the visit itself is stored: a reader that sees the new version is
+    guaranteed to also see the visit.
+    """
+    if visit_datetime is None:
+        visit_datetime = datetime.now(timezone.utc)
+    patient = visit.patient_search
+    visit_details = visit.visit_details
+    visit_details.facility_name = user.facility_name
+    visit_details.facility_type = user.facility_type
+    visit_details.visit_datetime = visit_datetime
+    # visit_date is only kept as a presentation of visit_datetime
+    visit_details.visit_date = visit_datetime.astimezone().strftime(VISIT_DATE_FORMAT)
+    if patient.is_child:
+        patient_filter, patient_update = child_upsert(
+            patient.id_number, patient.parent_name, patient.name)
+        document = visit_document(visit_details.model_dump(), patient.id_number, patient.name)
+    else:
+        patient_filter, patient_update = adult_upsert(patient.id_number, patient.name)
+        document = visit_document(visit_details.model_dump(), patient.id_number)
+    return patient_filter, patient_update, document
+
+
+async def patient_version(patients_collection, id_number: int,
+                          dependent_key: str | None = None) -> int:
+    """Current visit version of an adult or dependent, 0 if never versioned.
+
+    For adults the query is hinted to the (id_number, version) index, which
+    answers it without reading the patient document. A dependent's version
+    is inside the dependents array, which no index can return, so for them
+    the document is read, with only the dependents' name_key and version
+    projected.
+    """
+    if dependent_key is None:
+        patient = await patients_collection.find_one(
+            {'id_number': id_number}, projection={'_id': 0, 'version': 1},
+            hint='id_number_version')
+        return (patient or {}).get('version', 0)
+    patient = await patients_collection.find_one(
+        {'id_number': id_number},
+        projection={'_id': 0, 'dependents.name_key': 1, 'dependents.version': 1})
+    for child in (patient or {}).get('dependents', []):
+        if child.get('name_key') == dependent_key:
+            return child.get('version', 0)
+    return 0
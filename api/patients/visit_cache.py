@@ -0,0 +1,103 @@
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+VISIT_CACHE_SIZE = int(os.environ.get("VISIT_CACHE_SIZE", 1024))
+VISIT_CACHE_TTL = float(os.environ.get("VISIT_CACHE_TTL", 120))
+# longer histories are not worth the memory, they are read from the database
+VISIT_CACHE_MAX_VISITS = int(os.environ.get("VISIT_CACHE_MAX_VISITS", 500))
+# visits held by all entries together; with long clinical notes a visit
+# takes a few KB, so this bounds the cache to tens of MB per worker
+VISIT_CACHE_MAX_TOTAL_VISITS = int(os.environ.get("VISIT_CACHE_MAX_TOTAL_VISITS", 20000))
+
+
+class CachedVisits(NamedTuple):
+    expires_at: float
+    # patient version the visits were read at, see patient_store.visit_writes
+    version: int
+    # every facility's visits, with the storage-only fields removed
+    visits: list[dict]
+    # all visits are in the canonical shape and need no re-validation
+    trusted: bool
+
+
+class VisitCache:
+    """Per-patient read-through cache of visit histories with TTL + LRU eviction.
+
+    One entry per patient_key holds the visits from all facilities, so
+    different facilities searching the same patient share it; the caller's
+    own visits are filtered out on read. Writes through this worker call
+    invalidate(); writes made by other workers are caught by comparing the
+    entry's version with the patient's current version before it is served.
+
+    The least recently used entries are evicted once there are more than
+    maxsize of them or they hold more than max_visits visits together, so a
+    few long histories can not grow the worker without bound.
+    """
+
+    def __init__(self, maxsize: int = VISIT_CACHE_SIZE, ttl: float = VISIT_CACHE_TTL,
+                 max_visits: int = VISIT_CACHE_MAX_TOTAL_VISITS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_visits = max_visits
+        # visits held by all entries, kept within max_visits
+        self.visits = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, CachedVisits] = OrderedDict()
+
+    def get(self, key: str, version: int) -> CachedVisits | None:
+        """The entry for key if it was read at the patient's current version"""
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            self.invalidate(key)
+            entry = None
+        if entry is not None and entry.version != version:
+            # another worker stored a visit since
+            self.invalidate(key)
+            self.stale += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, version: int, visits: list[dict], trusted: bool):
+        if self.maxsize <= 0 or len(visits) > min(VISIT_CACHE_MAX_VISITS, self.max_visits):
+            return
+        self.invalidate(key)
+        self._entries[key] = CachedVisits(time.monotonic() + self.ttl, version, visits, trusted)
+        self.visits += len(visits)
+        while len(self._entries) > self.maxsize or self.visits > self.max_visits:
+            _, evicted = self._entries.popitem(last=False)
+            self.visits -= len(evicted.visits)
+            self.evictions += 1
+
+    def invalidate(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.visits -= len(entry.visits)
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'visits': self.visits,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+visit_cache = VisitCache()
@@ -0,0 +1,167 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from dotenv import load_dotenv
+from pydantic import BaseModel
+
+from ..app import db
+from ..indexes import collection_name
+from ..responses import ORJSONResponse
+from .patient_models import name_key
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+VISIT_DATE_FORMAT = "%a %d %b %Y, %I:%M%p"
+visits_collection = db[collection_name("VISIT_COLLECTION")]
+
+# bump whenever the stored shape of a validated VisitDetails changes
+VISIT_SCHEMA_VERSION = 2
+# serve visits stamped with the current schema_version without re-validation
+VISIT_TRUSTED_READS = os.environ.get("VISIT_TRUSTED_READS", "true").lower() == "true"
+# audit mode: validate every read and log visits whose stored form differs
+VISIT_VERIFY_READS = os.environ.get("VISIT_VERIFY_READS", "false").lower() == "true"
+
+logger = logging.getLogger(__name__)
+
+# fields that only exist for storage and are never part of VisitDetails
+STORAGE_FIELDS = ('_id', 'patient_key', 'id_number', 'dependent_key',
+                  'legacy_source', 'legacy_index', 'schema_version')
+VISIT_PROJECTION = {field: 0 for field in STORAGE_FIELDS}
+
+
+def patient_key(id_number: int, child_name: str | None = None) -> str:
+    """Key shared by every visit of one adult, or of one of their dependents"""
+    if child_name is None:
+        return str(id_number)
+    return f"{id_number}:{name_key(child_name)}"
+
+
+def parse_visit_date(visit_date: str | None) -> datetime | None:
+    """Best effort conversion of a legacy visit_date string to a UTC datetime"""
+    if not visit_date:
+        return None
+    try:
+        parsed = datetime.strptime(visit_date, VISIT_DATE_FORMAT)
+    except ValueError:
+        return None
+    # legacy strings were written from the naive local server clock
+    return parsed.astimezone(timezone.utc)
+
+
+def visit_document(visit: dict, id_number: int, child_name: str | None = None) -> dict:
+    """Build the stored form of a visit from a dumped VisitDetails.
+
+    Only visits dumped from a validated model get the current schema_version,
+    which is what allows them to be served later without re-validation.
+    """
+    visit_datetime = visit.get('visit_datetime') or parse_visit_date(visit.get('visit_date'))
+    return {
+        **visit,
+        'patient_key': patient_key(id_number, child_name),
+        'id_number': id_number,
+        'dependent_key': name_key(child_name) if child_name is not None else None,
+        'visit_datetime': visit_datetime,
+        'schema_version': VISIT_SCHEMA_VERSION,
+    }
+
+
+def strip_schema_versions(visits: list[dict]) -> bool:
+    """Remove schema_version from visits read with it, and return whether all
+    of them were stored in the current canonical shape"""
+    trusted = True
+    for visit in visits:
+        if visit.pop('schema_version', None) != VISIT_SCHEMA_VERSION:
+            trusted = False
+    return trusted
+
+
+def visits_response(content: dict, model: type[BaseModel],
+                    trusted: bool | None = None) -> ORJSONResponse:
+    """Respond with content['visits'] as read, skipping response_model validation
+    when every visit was stored in the current canonical shape.
+
+    Anything else (legacy or older shapes) goes through model validation, as
+    does everything in VISIT_VERIFY_READS audit mode. Pass trusted when the
+    schema versions were already stripped, e.g. for cached visits.
+    """
+    if trusted is None:
+        trusted = strip_schema_versions(content['visits'])
+    trusted = trusted and VISIT_TRUSTED_READS
+    if trusted and not VISIT_VERIFY_READS:
+        return ORJSONResponse(content)
+    validated = model.model_validate(content).model_dump()
+    if VISIT_VERIFY_READS:
+        for stored, checked in zip(content['visits'], validated['visits']):
+            if stored != checked:
+                logger.warning("stored visit differs from its validated form: %s", stored)
+    return ORJSONResponse(validated)
+
+
+def search_etag(key: str, facility_name: str, version: int, media_type: str) -> str:
+    """ETag of a /patients/search result: the patient's visit version, scoped
+    to the searching facility (whose own visits are left out), the response
+    shape and the representation (a JSON array or NDJSON lines)"""
+    scope = hashlib.sha1(
+        f'{key}|{facility_name}|{VISIT_SCHEMA_VERSION}|{media_type}'.encode('utf-8')).hexdigest()[:16]
+    return f'"{scope}-{version}"'
+
+
+def encode_cursor(visit: dict) -> str:
+    """Opaque continuation token pointing just past the given stored visit"""
+    visit_datetime = visit.get('visit_datetime')
+    position = {
+        't': visit_datetime.isoformat() if visit_datetime else None,
+        'id': str(visit['_id']),
+    }
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime | None, ObjectId]:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        visit_datetime = position['t']
+        if visit_datetime is not None:
+            visit_datetime = datetime.fromisoformat(visit_datetime)
+        return visit_datetime, ObjectId(position['id'])
+    except (ValueError, TypeError, KeyError, InvalidId):
+        raise ValueError('Invalid cursor')
+
+
+def visit_page_filter(key: str, exclude_facility: str,
+                      since: datetime | None = None, until: datetime | None = None,
+                      cursor: str | None = None) -> dict:
+    """Filter for one newest-first page of a patient's visits.
+
+    Pages are sorted on (visit_datetime, _id) descending, which the
+    patient_key_visit_datetime index serves directly, so a cursor resumes with
+    a range scan instead of skipping over earlier pages.
+    """
+    conditions = [{'patient_key': key, 'facility_name': {'$ne': exclude_facility}}]
+    if since is not None or until is not None:
+        window = {}
+        if since is not None:
+            window['$gte'] = since
+        if until is not None:
+            window['$lt'] = until
+        conditions.append({'visit_datetime': window})
+    if cursor is not None:
+        last_datetime, last_id = decode_cursor(cursor)
+        if last_datetime is None:
+            # visits without a datetime sort last and are ordered by _id alone
+            conditions.append({'visit_datetime': None, '_id': {'$lt': last_id}})
+        else:
+            conditions.append({'$or': [
+                {'visit_datetime': {'$lt': last_datetime}},
+                {'visit_datetime': None},
+                {'visit_datetime': last_datetime, '_id': {'$lt': last_id}},
+            ]})
+    return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
+
+VISIT_PAGE_SORT = [('visit_datetime', -1), ('_id', -1)]
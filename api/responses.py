@@ -0,0 +1,46 @@
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+
+# the Motor client is tz_aware, so stored datetimes come back as aware UTC;
+# OPT_NAIVE_UTC only matters for naive ones, e.g. parsed from a request
+# without a UTC offset, which are then marked as UTC
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+
+
+def orjson_default(value: Any):
+    """Encode the BSON/stdlib types orjson does not know natively"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal):
+        # same as pydantic's JSON mode, keeps full precision
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=orjson_default, option=ORJSON_OPTIONS)
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an If-None-Match header names etag. The comparison is weak, as
+    RFC 9110 asks for If-None-Match, so a W/ prefix on either side is ignored:
+    compressed responses carry the weak form of the route's ETag."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == opaque_tag for tag in if_none_match.split(','))
+
+
+class ORJSONResponse(JSONResponse):
+    """Default response class for the app, encoding with orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
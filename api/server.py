@@ -0,0 +1,80 @@
+"""Production server entrypoint.
+
+    python -m api.server
+
+Runs the app under uvicorn with one worker process per available CPU by
+default, counting the container's CPU quota rather than the host's cores.
+Each worker has its own MongoDB pool, so the server as a whole holds up to
+workers x MONGO_MAX_POOL_SIZE connections.
+Workers are spawned fresh rather than forked from a parent that already
+imported the app, so each worker creates its own Motor client and pool.
+Every setting can be overridden from the environment.
+"""
+import math
+import os
+
+import uvicorn
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+
+def cgroup_cpu_quota() -> float | None:
+    """CPUs allowed by the cgroup CPU quota (v2 or v1), None when unlimited
+    or not running under one"""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, _, period = f.read().partition(' ')
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return quota / period if quota > 0 and period > 0 else None
+
+
+def available_cpus() -> int:
+    """CPUs this process may actually use: the ones it is pinned to, capped
+    by the container's CPU quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def server_settings() -> dict:
+    return {
+        'host': os.environ.get("HOST", "0.0.0.0"),
+        'port': int(os.environ.get("PORT", 80)),
+        # WEB_CONCURRENCY is the conventional name used by hosting platforms
+        'workers': int(os.environ.get("WEB_CONCURRENCY", available_cpus())),
+        'loop': os.environ.get("UVICORN_LOOP", "uvloop"),
+        'http': os.environ.get("UVICORN_HTTP", "httptools"),
+        'backlog': int(os.environ.get("UVICORN_BACKLOG", 2048)),
+        'timeout_keep_alive': int(os.environ.get("UVICORN_KEEP_ALIVE", 5)),
+        'timeout_graceful_shutdown': int(os.environ.get("UVICORN_GRACEFUL_TIMEOUT", 30)),
+        'limit_concurrency': int(os.environ["UVICORN_LIMIT_CONCURRENCY"])
+            if os.environ.get("UVICORN_LIMIT_CONCURRENCY") else None,
+        'proxy_headers': os.environ.get("PROXY_HEADERS", "true").lower() == "true",
+        'forwarded_allow_ips': os.environ.get("FORWARDED_ALLOW_IPS", "*"),
+        'access_log': os.environ.get("UVICORN_ACCESS_LOG", "true").lower() == "true",
+    }
+
+
+def main():
+    uvicorn.run("api.app:app", **server_settings())
+
+
+if __name__ == '__main__':
+    main()
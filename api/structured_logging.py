@@ -0,0 +1,197 @@
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from dotenv import load_dotenv
+
+from .responses import dumps
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "json" for log shippers, "text" for reading a terminal
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+# per-logger levels, e.g. "uvicorn.access=WARNING,api.patients=DEBUG"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# share of requests per route whose INFO and DEBUG records are kept,
+# e.g. "/patients/search=0.1"; warnings and errors are always kept
+LOG_SAMPLE_RATES = os.environ.get("LOG_SAMPLE_RATES", "")
+# records waiting for the writer thread; past this they are dropped
+# rather than blocking the event loop
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+REQUEST_ID_HEADER = os.environ.get("REQUEST_ID_HEADER", "X-Request-ID")
+# ids a client may choose; anything else is replaced, so a request id can
+# not inject text into the logs or bloat every record
+_REQUEST_ID = re.compile(r'[A-Za-z0-9-]{1,64}')
+
+request_id_var: ContextVar[str | None] = ContextVar('request_id', default=None)
+route_var: ContextVar[str | None] = ContextVar('route', default=None)
+
+# attributes every LogRecord has; anything else was passed in extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message', 'asctime', 'request_id', 'route'}
+
+
+def parse_settings(value: str, convert) -> dict:
+    """"name=value,name=value" to a dict, converting each value"""
+    settings = {}
+    for item in value.split(','):
+        name, _, setting = item.partition('=')
+        if name.strip() and setting.strip():
+            settings[name.strip()] = convert(setting.strip())
+    return settings
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamp records with the request they were logged in, and sample the
+    chatty ones per route.
+
+    Runs in the thread that logs, before the record is queued, because the
+    request context does not reach the writer thread. Sampling is decided
+    from the request id, so a request's records are kept or dropped together.
+    """
+
+    def __init__(self, sample_rates: dict[str, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.route = route_var.get()
+        if record.levelno > logging.INFO or record.request_id is None:
+            return True
+        rate = self.sample_rates.get(record.route)
+        if rate is None:
+            return True
+        return int(uuid.uuid5(uuid.NAMESPACE_OID, record.request_id).hex[:8], 16) < rate * 0x100000000
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never waits: when the writer falls behind, records
+    are counted and dropped"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # render the message and traceback here, but leave the layout to the
+        # writer's formatter
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with extra= fields at the top level"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None) is not None:
+            entry['request_id'] = record.request_id
+            entry['route'] = record.route
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return dumps(entry).decode('utf-8')
+
+    def formatTime(self, record: logging.LogRecord, datefmt=None) -> str:
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z'
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, 'request_id'):
+            record.request_id = None
+        return super().format(record)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route every logger through a bounded queue to a writer thread.
+
+    Handlers that were already on the root logger are replaced. The returned
+    listener must be stopped on shutdown so queued records are written out.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JSONFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter(parse_settings(LOG_SAMPLE_RATES, float)))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_settings(LOG_LEVELS, str.upper).items():
+        logging.getLogger(name).setLevel(level)
+    # uvicorn's own loggers only need to pass their records to the root
+    for name in ('uvicorn', 'uvicorn.error', 'uvicorn.access'):
+        logging.getLogger(name).handlers.clear()
+        logging.getLogger(name).propagate = True
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+
+class RequestContextMiddleware:
+    """Give every request an id, taken from the REQUEST_ID_HEADER header when
+    the client (or a proxy) sent a well-formed one, make it available to log
+    records and echo it back on the response"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        request_id = Headers(scope=scope).get(REQUEST_ID_HEADER)
+        if request_id is None or not _REQUEST_ID.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        request_id_token = request_id_var.set(request_id)
+        route_token = route_var.set(scope['path'])
+
+        async def send_with_request_id(message: Message):
+            if message['type'] == 'http.response.start':
+                MutableHeaders(scope=message)[REQUEST_ID_HEADER] = request_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(request_id_token)
+            route_var.reset(route_token)
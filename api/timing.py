@@ -0,0 +1,132 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+# send the phase timings of each request in a Server-Timing header; they
+# show in browser dev tools, so keep this off unless the clients are trusted
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() == "true"
+# upper bounds, in milliseconds, of the phase histogram buckets
+TIMING_BUCKETS_MS = [
+    float(bound) for bound in
+    os.environ.get("TIMING_BUCKETS_MS", "1,2.5,5,10,25,50,100,250,500,1000,2500").split(',')]
+# how often the histograms are logged, 0 to never log them
+TIMING_REPORT_SECONDS = float(os.environ.get("TIMING_REPORT_SECONDS", 300))
+
+logger = logging.getLogger(__name__)
+
+# milliseconds spent in each phase of the current request
+request_timings: ContextVar[dict[str, float] | None] = ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def phase(name: str):
+    """Time the enclosed block as a phase of the current request.
+
+    Works around awaits as well, in which case the time includes waiting on
+    the database. Blocks entered outside of a request are not timed.
+    """
+    timings = request_timings.get()
+    if timings is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + (time.perf_counter() - started_at) * 1000
+
+
+class PhaseHistograms:
+    """Latency histograms per route and phase, kept since the worker started"""
+
+    def __init__(self, bounds: list[float] = TIMING_BUCKETS_MS):
+        self.bounds = sorted(bounds)
+        # (route, phase) -> [count, total ms, one count per bucket + overflow]
+        self._histograms: dict[tuple[str, str], list] = {}
+
+    def record(self, route: str, timings: dict[str, float]):
+        for name, duration in timings.items():
+            histogram = self._histograms.get((route, name))
+            if histogram is None:
+                histogram = self._histograms[(route, name)] = [0, 0.0, [0] * (len(self.bounds) + 1)]
+            histogram[0] += 1
+            histogram[1] += duration
+            histogram[2][bisect.bisect_left(self.bounds, duration)] += 1
+
+    def snapshot(self) -> dict:
+        routes = {}
+        for (route, name), (count, total, buckets) in self._histograms.items():
+            labels = [str(bound) for bound in self.bounds] + ['+Inf']
+            routes.setdefault(route, {})[name] = {
+                'count': count,
+                'mean_ms': total / count,
+                'buckets': dict(zip(labels, buckets)),
+            }
+        return routes
+
+
+phase_histograms = PhaseHistograms()
+
+
+def server_timing(timings: dict[str, float]) -> str:
+    return ', '.join(f'{name};dur={duration:.2f}' for name, duration in timings.items())
+
+
+class ServerTimingMiddleware:
+    """Collect the phases timed during a request, add them to the response as
+    a Server-Timing header when SERVER_TIMING is on, and record them in
+    phase_histograms under the route's path template.
+
+    The "app" phase is the whole time until the response started.
+    """
+
+    def __init__(self, app: ASGIApp, enabled: bool = SERVER_TIMING):
+        self.app = app
+        self.enabled = enabled
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timings = {}
+        token = request_timings.set(timings)
+        started_at = time.perf_counter()
+
+        async def send_with_timings(message: Message):
+            if message['type'] == 'http.response.start':
+                timings['app'] = (time.perf_counter() - started_at) * 1000
+                if self.enabled:
+                    MutableHeaders(scope=message).append('Server-Timing', server_timing(timings))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            request_timings.reset(token)
+            # only matched routes, so unknown paths can not grow the histograms
+            route = scope.get('route')
+            if route is not None and timings:
+                phase_histograms.record(route.path, timings)
+
+
+async def report(interval: float = TIMING_REPORT_SECONDS, **snapshots):
+    """Log the phase histograms every interval seconds, along with the
+    snapshot() of every other metric source passed by name"""
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("metrics", extra={
+            'timings': phase_histograms.snapshot(),
+            **{name: snapshot() for name, snapshot in snapshots.items()}})
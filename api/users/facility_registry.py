@@ -0,0 +1,351 @@
+import asyncio
+import bisect
+import hashlib
+import heapq
+import json
+import logging
+import os
+import re
+import sys
+from collections import defaultdict
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+from pydantic import ValidationError
+from pymongo.errors import OperationFailure, PyMongoError
+
+from ..dependencies.principal_cache import principal_cache
+from .user_models import FacilityRecord
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+# optional registry file to load instead of the facilities collection
+FACILITY_REGISTRY_FILE = os.environ.get("FACILITY_REGISTRY_FILE")
+# how often to look for changes when change streams are not available
+FACILITY_REGISTRY_POLL_SECONDS = float(os.environ.get("FACILITY_REGISTRY_POLL_SECONDS", 300))
+# minimum trigram similarity (0-1) for a facility to be suggested
+FACILITY_SUGGEST_MIN_SCORE = float(os.environ.get("FACILITY_SUGGEST_MIN_SCORE", 0.4))
+# server error code for a change stream opened outside a replica set
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+logger = logging.getLogger(__name__)
+
+
+class Facility(NamedTuple):
+    facility_name: str
+    facility_type: str
+    status: str
+
+
+_PUNCTUATION = re.compile(r'[^\w\s]+')
+
+
+def normalize_name(name: str) -> str:
+    """Case, punctuation and whitespace insensitive form of a facility name"""
+    return ' '.join(_PUNCTUATION.sub(' ', name.casefold()).split())
+
+
+def trigrams(normalized: str) -> set[str]:
+    padded = f'  {normalized} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def facility_hash(record: dict) -> str:
+    """Content hash of a registry entry, stored alongside it as content_hash"""
+    content = json.dumps([record['facility_name'], record['facility_type'], record['status']])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+REGISTRY_FIELDS = {'_id': 0, 'facility_name': 1, 'facility_type': 1, 'status': 1}
+
+
+async def read_registry(collection) -> list[dict]:
+    """Every stored entry, without _id.
+
+    Sorting on facility_name lets the planner answer this from the
+    (facility_name, facility_type, status) index alone, without fetching
+    the documents.
+    """
+    return await collection.find(
+        {}, projection=REGISTRY_FIELDS, sort=[('facility_name', 1)]).to_list(None)
+
+
+def read_registry_file(path: str) -> tuple[list[dict], float]:
+    with open(path) as f:
+        return json.load(f), os.stat(path).st_mtime
+
+
+def valid_records(records) -> tuple[list[dict], list]:
+    """The records that are valid FacilityRecords, and the ones that are not"""
+    valid, invalid = [], []
+    for record in records:
+        try:
+            valid.append(FacilityRecord.model_validate(record).model_dump())
+        except ValidationError:
+            invalid.append(record)
+    return valid, invalid
+
+
+def bitset(positions, length: int) -> int:
+    """Int with the given bits set"""
+    bits = bytearray((length + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class FacilityNameIndex:
+    """Trigram index over normalized facility names for ranked suggestions.
+
+    Every trigram maps to an int with one bit per name that has it. Adding a
+    query's trigram ints into a bit-sliced counter (bit p of slice i is bit i
+    of name p's count) counts the shared trigrams of every name at once, in
+    a few big-int operations per trigram. Names are then taken a count at a
+    time from the highest down; within a count a shorter name scores higher,
+    and names are numbered from the shortest, so each count is scanned in
+    order until its scores drop below the worst one still needed.
+    """
+
+    def __init__(self, names):
+        grams = {name: trigrams(normalize_name(name)) for name in names}
+        # numbered by trigram count, so "at most n trigrams" is a bit range
+        self.names = sorted(grams, key=lambda name: len(grams[name]))
+        self.sizes = [len(grams[name]) for name in self.names]
+        postings = defaultdict(list)
+        for position, name in enumerate(self.names):
+            for gram in grams[name]:
+                postings[gram].append(position)
+        self.postings = {gram: bitset(positions, len(self.names))
+                         for gram, positions in postings.items()}
+
+    def _counts(self, query_grams) -> list[int]:
+        """Bit slices, least significant first, of each name's number of
+        trigrams shared with the query"""
+        slices = []
+        for gram in query_grams:
+            carry = self.postings.get(gram, 0)
+            for i, bits in enumerate(slices):
+                if not carry:
+                    break
+                slices[i], carry = bits ^ carry, bits & carry
+            if carry:
+                slices.append(carry)
+        return slices
+
+    def search(self, query: str, limit: int = 5,
+               min_score: float = FACILITY_SUGGEST_MIN_SCORE) -> list[tuple[str, float]]:
+        query_grams = trigrams(normalize_name(query))
+        if not query_grams or not self.names:
+            return []
+        size = len(query_grams)
+        slices = self._counts(query_grams)
+        best = []
+        floor = min_score
+        for shared in range(min(size, (1 << len(slices)) - 1), 0, -1):
+            # Jaccard similarity is at most shared / size
+            if shared < floor * size:
+                break
+            # shared / (size + name_size - shared) >= floor bounds name_size
+            longest = (bisect.bisect_right(self.sizes, shared / floor - size + shared)
+                       if floor > 0 else len(self.sizes))
+            level = (1 << longest) - 1
+            for i, bits in enumerate(slices):
+                level &= bits if shared >> i & 1 else ~bits
+            while level:
+                low = level & -level
+                level ^= low
+                position = low.bit_length() - 1
+                score = shared / (size + self.sizes[position] - shared)
+                if score < floor:
+                    break
+                heapq.heappush(best, (score, -position))
+                if len(best) > limit:
+                    heapq.heappop(best)
+                if len(best) == limit:
+                    floor = max(floor, best[0][0])
+        return [(self.names[-position], round(score, 3))
+                for score, position in sorted(best, reverse=True)]
+
+
+class RegistryState(NamedTuple):
+    by_name: dict[str, Facility]
+    # normalized name -> every registered name with that normal form
+    by_normalized: dict[str, list[str]]
+    hashes: dict[str, str]
+    name_index: FacilityNameIndex
+
+
+class FacilityRegistry:
+    """In-memory index of the regulator's facility registry.
+
+    Lookups by exact name and by normalized name are plain dict hits, so
+    registration does not need a database round trip. Every entry keeps its
+    content hash so a refresh only invalidates the facilities that changed.
+
+    The lookup tables are never modified in place: a change builds a new
+    RegistryState next to the current one, in a worker thread since indexing
+    thousands of names takes a few hundred milliseconds, and swaps it in
+    with a single assignment on the event loop, so readers always see one
+    consistent version.
+    """
+
+    def __init__(self):
+        self._state = RegistryState({}, {}, {}, FacilityNameIndex(()))
+        # one change at a time, each building on the state the last one left
+        self._changing = asyncio.Lock()
+        self.loaded = False
+        self._file_mtime = None
+
+    def __len__(self):
+        return len(self._state.by_name)
+
+    def _build(self, records, removed_names=(), complete=False) -> tuple[RegistryState, list[str]]:
+        """The state with the given entries added or updated and removed ones
+        dropped, plus the names whose content actually changed. When records
+        is the complete registry, every other entry is removed. Only reads
+        the current state.
+
+        Entries that are not valid FacilityRecords, e.g. edited by hand
+        without a status, are logged and left out rather than failing the
+        whole load.
+        """
+        state = self._state
+        records, invalid = valid_records(records)
+        if invalid:
+            logger.warning("skipping %d invalid facility registry entries, first: %s",
+                           len(invalid), invalid[0])
+        if complete:
+            names = {record['facility_name'] for record in records}
+            removed_names = [name for name in state.by_name if name not in names]
+        by_name, hashes = dict(state.by_name), dict(state.hashes)
+        changed = []
+        for record in records:
+            facility_name = record['facility_name']
+            content_hash = facility_hash(record)
+            if hashes.get(facility_name) != content_hash:
+                by_name[facility_name] = Facility(facility_name,
+                                                  sys.intern(record['facility_type']),
+                                                  sys.intern(record['status']))
+                hashes[facility_name] = content_hash
+                changed.append(facility_name)
+        for facility_name in removed_names:
+            if by_name.pop(facility_name, None) is not None:
+                del hashes[facility_name]
+                changed.append(facility_name)
+        if not changed:
+            return state, changed
+        by_normalized = {}
+        for facility_name in by_name:
+            by_normalized.setdefault(normalize_name(facility_name), []).append(facility_name)
+        return RegistryState(by_name, by_normalized, hashes, FacilityNameIndex(by_name)), changed
+
+    async def apply(self, records, removed_names=(), complete=False) -> list[str]:
+        """Add or update the given entries, drop removed ones, and return the
+        names whose content actually changed"""
+        async with self._changing:
+            self._state, changed = await asyncio.to_thread(self._build, records, removed_names, complete)
+        # users of a changed facility may hold a stale facility_type/status
+        for facility_name in changed:
+            principal_cache.invalidate_facility(facility_name)
+        self.loaded = True
+        return changed
+
+    async def replace(self, records) -> list[str]:
+        return await self.apply(records, complete=True)
+
+    def get(self, facility_name: str) -> Facility | None:
+        """Exact name lookup, falling back to an unambiguous normalized match"""
+        state = self._state
+        facility = state.by_name.get(facility_name)
+        if facility is None:
+            # names that only differ by case/spacing are ambiguous
+            names = state.by_normalized.get(normalize_name(facility_name))
+            if names and len(names) == 1:
+                facility = state.by_name[names[0]]
+        return facility
+
+    def suggest(self, facility_name: str, limit: int = 5) -> list[tuple[Facility, float]]:
+        """Registered facilities with names similar to facility_name, best first"""
+        state = self._state
+        return [(state.by_name[name], score)
+                for name, score in state.name_index.search(facility_name, limit)]
+
+    def status(self, facility_name: str) -> str | None:
+        facility = self.get(facility_name)
+        return facility.status if facility else None
+
+    def facility_type(self, facility_name: str) -> str | None:
+        facility = self.get(facility_name)
+        return facility.facility_type if facility else None
+
+    async def load_file(self, path: str):
+        records, mtime = await asyncio.to_thread(read_registry_file, path)
+        await self.replace(records)
+        self._file_mtime = mtime
+        logger.info("loaded %d facilities from %s", len(self), path)
+
+    async def load_collection(self, collection):
+        await self.replace(await read_registry(collection))
+        logger.info("loaded %d facilities from %s", len(self), collection.name)
+
+    async def refresh_collection(self, collection) -> list[str]:
+        """Re-read the registry and apply the entries that changed.
+
+        Hashes are computed from the stored fields rather than trusting a
+        stored content_hash, so entries seeded without one, or edited
+        without updating it, are still picked up.
+        """
+        changed = await self.replace(await read_registry(collection))
+        if changed:
+            logger.info("refreshed %d facilities from %s", len(changed), collection.name)
+        return changed
+
+    async def load(self, collection):
+        if FACILITY_REGISTRY_FILE:
+            await self.load_file(FACILITY_REGISTRY_FILE)
+        else:
+            await self.load_collection(collection)
+
+    async def follow(self, collection):
+        """Refresh on every burst of changes from a change stream"""
+        async with collection.watch() as stream:
+            async for _ in stream:
+                # fold a burst of changes into a single reload
+                while await stream.try_next() is not None:
+                    pass
+                await self.refresh_collection(collection)
+
+    async def watch(self, collection):
+        """Reload whenever the registry source changes, until cancelled.
+
+        A collection is followed with a change stream where the deployment
+        supports one (replica sets); otherwise the source is polled. A stream
+        that fails for another reason (network, failover) is reopened after a
+        poll, which also picks up the changes missed in between.
+        """
+        use_stream = not FACILITY_REGISTRY_FILE
+        while True:
+            if use_stream:
+                try:
+                    await self.follow(collection)
+                except PyMongoError as e:
+                    if isinstance(e, OperationFailure) and e.code == CHANGE_STREAM_UNSUPPORTED:
+                        logger.info("change streams unavailable, polling facility registry")
+                        use_stream = False
+                    else:
+                        logger.warning("facility registry change stream failed, reopening after a poll",
+                                       exc_info=True)
+                except Exception:
+                    logger.exception("facility registry change stream failed, reopening after a poll")
+            await asyncio.sleep(FACILITY_REGISTRY_POLL_SECONDS)
+            try:
+                if FACILITY_REGISTRY_FILE:
+                    if os.stat(FACILITY_REGISTRY_FILE).st_mtime != self._file_mtime:
+                        await self.load_file(FACILITY_REGISTRY_FILE)
+                else:
+                    await self.refresh_collection(collection)
+            except Exception:
+                logger.exception("facility registry reload failed, keeping previous copy")
+
+
+facility_registry = FacilityRegistry()
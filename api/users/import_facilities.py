@@ -0,0 +1,175 @@
+"""Load a facility registry file (a JSON array such as clean_facilities.txt)
+into the facilities collection.
+
+    python -m api.users.import_facilities clean_facilities.txt --batch-size 1000
+    python -m api.users.import_facilities clean_facilities.txt --sync --changelog changes.ndjson
+
+The file is parsed incrementally and written in unordered bulk upserts keyed
+on facility_name, so memory use stays flat however large the registry is.
+
+With --sync only records whose content hash differs from the stored one are
+written, and every added, changed or (with --prune) removed facility is
+written to the change log. Stored entries are hashed from their fields, so
+entries edited by hand are compared as they are. Running API workers pick
+the changes up through their registry refresh.
+"""
+import argparse
+import asyncio
+import json
+import os
+from typing import Iterator, TextIO
+
+from pydantic import ValidationError
+from pymongo import UpdateOne
+
+from ..app import db
+from .user_models import FacilityRecord
+from .facility_registry import facility_hash, read_registry
+
+facilities_collection = db.get_collection(os.environ.get('FACILITIES_COLLECTION'))
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_json_array(f: TextIO, chunk_size: int = 1 << 16) -> Iterator[object]:
+    """Yield the items of a top level JSON array without reading it all at once"""
+    buffer = ''
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        # drop what has already been consumed before growing the buffer
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def skip(chars: str):
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in chars:
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            fill()
+
+    skip(_WHITESPACE)
+    if buffer[position:position + 1] != '[':
+        raise ValueError('Registry file must contain a JSON array')
+    position += 1
+    while True:
+        skip(_WHITESPACE + ',')
+        if position >= len(buffer):
+            raise ValueError('Unterminated JSON array')
+        if buffer[position] == ']':
+            return
+        try:
+            item, end = _decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        # a value cut at the end of the buffer may still decode (e.g. numbers)
+        if end == len(buffer) and not eof:
+            fill()
+            continue
+        position = end
+        yield item
+
+
+def facility_upsert(record: FacilityRecord, content_hash: str) -> UpdateOne:
+    return UpdateOne(
+        {'facility_name': record.facility_name},
+        {'$set': {'facility_type': record.facility_type, 'status': record.status,
+                  'content_hash': content_hash}},
+        upsert=True)
+
+
+async def stored_registry() -> dict[str, tuple[str | None, str | None]]:
+    """facility_name -> (content hash, status) for everything stored"""
+    return {doc['facility_name']: (facility_hash(doc), doc['status'])
+            for doc in await read_registry(facilities_collection)}
+
+
+async def import_facilities(path: str, batch_size: int = 1000, sync: bool = False,
+                            prune: bool = False, changelog: TextIO | None = None) -> dict[str, int]:
+    counts = {'read': 0, 'invalid': 0, 'unchanged': 0, 'inserted': 0, 'updated': 0,
+              'removed': 0, 'revoked': 0}
+    batch = []
+    stored = await stored_registry() if sync else {}
+    seen = set()
+
+    def log_change(change: str, facility_name: str, old_status, new_status):
+        if changelog is not None:
+            changelog.write(json.dumps({'change': change, 'facility_name': facility_name,
+                                        'old_status': old_status,
+                                        'new_status': new_status}) + '\n')
+
+    async def flush():
+        if batch:
+            result = await facilities_collection.bulk_write(batch, ordered=False)
+            counts['inserted'] += result.upserted_count
+            counts['updated'] += result.modified_count
+            batch.clear()
+
+    with open(path) as f:
+        for item in iter_json_array(f):
+            counts['read'] += 1
+            try:
+                record = FacilityRecord.model_validate(item)
+            except ValidationError as e:
+                counts['invalid'] += 1
+                print(f"skipping record {counts['read']}: {e.errors(include_url=False)}")
+                continue
+            content_hash = facility_hash(record.model_dump())
+            if sync:
+                seen.add(record.facility_name)
+                old_hash, old_status = stored.get(record.facility_name, (None, None))
+                if old_hash == content_hash:
+                    counts['unchanged'] += 1
+                    continue
+                if record.status != 'Active' and old_status == 'Active':
+                    counts['revoked'] += 1
+                log_change('updated' if record.facility_name in stored else 'added',
+                           record.facility_name, old_status, record.status)
+            elif record.status != 'Active':
+                counts['revoked'] += 1
+            batch.append(facility_upsert(record, content_hash))
+            if len(batch) >= batch_size:
+                await flush()
+    await flush()
+
+    if sync and prune:
+        removed = [name for name in stored if name not in seen]
+        for start in range(0, len(removed), batch_size):
+            chunk = removed[start:start + batch_size]
+            result = await facilities_collection.delete_many({'facility_name': {'$in': chunk}})
+            counts['removed'] += result.deleted_count
+        for name in removed:
+            log_change('removed', name, stored[name][1], None)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='registry file holding a JSON array of facilities')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='upserts sent per bulk write')
+    parser.add_argument('--sync', action='store_true',
+                        help='only write facilities whose content changed')
+    parser.add_argument('--prune', action='store_true',
+                        help='with --sync, delete facilities missing from the file')
+    parser.add_argument('--changelog', type=argparse.FileType('w'),
+                        help='with --sync, write one JSON line per change here (- for stdout)')
+    args = parser.parse_args()
+    counts = asyncio.run(import_facilities(args.path, args.batch_size, sync=args.sync,
+                                           prune=args.prune, changelog=args.changelog))
+    print(', '.join(f'{name}: {count}' for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+# per process; production runs one process per core, so a few threads each
+# are enough to keep every core busy hashing
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+HASH_MAX_QUEUE = int(os.environ.get("PASSWORD_HASH_MAX_QUEUE", 64))
+HASH_QUEUE_TIMEOUT = float(os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT", 5.0))
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+
+
+class HashMetrics:
+    """Running totals for time spent queued vs. time spent inside bcrypt"""
+
+    def __init__(self):
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+
+    def record(self, queue_wait: float, hash_time: float):
+        self.completed += 1
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.hash_time_total += hash_time
+        self.hash_time_max = max(self.hash_time_max, hash_time)
+
+    def snapshot(self) -> dict:
+        completed = self.completed or 1
+        return {
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'queue_wait_avg': self.queue_wait_total / completed,
+            'queue_wait_max': self.queue_wait_max,
+            'hash_time_avg': self.hash_time_total / completed,
+            'hash_time_max': self.hash_time_max,
+        }
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded thread pool so the event loop stays free.
+
+    bcrypt releases the GIL while hashing, so threads give real parallelism.
+    At most `workers` hashes run at once and at most `max_queue` more may wait;
+    anything beyond that is rejected with a 503 instead of piling up.
+    """
+
+    def __init__(self, workers: int = HASH_WORKERS, max_queue: int = HASH_MAX_QUEUE,
+                 queue_timeout: float = HASH_QUEUE_TIMEOUT, rounds: int = BCRYPT_ROUNDS):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rounds = rounds
+        self.metrics = HashMetrics()
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = None
+        self._pending = 0
+
+    def _busy(self):
+        self.metrics.rejected += 1
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Authentication service busy, try again shortly',
+            headers={'Retry-After': '1'},
+        )
+
+    async def _run(self, func, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        if self._pending >= self.workers + self.max_queue:
+            raise self._busy()
+        self._pending += 1
+        try:
+            queued_at = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._busy()
+            try:
+                started_at = time.perf_counter()
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self._executor, func, *args)
+                self.metrics.record(started_at - queued_at,
+                                    time.perf_counter() - started_at)
+                return result
+            finally:
+                self._slots.release()
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        """Hash a plain text password with a fresh salt"""
+        hashed = await self._run(
+            bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+        return hashed.decode('utf-8')
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        """Check a plain text password against a stored bcrypt hash"""
+        return await self._run(
+            bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+password_hasher = PasswordHasher()
@@ -37,6 +37,15 @@ class UserRegistration(BaseModel):
     def serialize_name(self, name: str, _info):
         return name.title()
     
+class FacilityRecord(BaseModel):
+    """Schema to validate a facility entry from the regulator's registry"""
+    facility_name: str = Field(min_length=1)
+    facility_type: str
+    status: str
+
+    class Config:
+        json_schema_extra = {"hidden": True}
+
 class User(BaseModel):
     """Pydantic schema to store authenticated user details"""
     email: str
@@ -1,26 +1,31 @@
 from typing import Annotated
 
-from fastapi import status, Body, HTTPException, Depends, APIRouter
+from fastapi import status, Body, HTTPException, Depends, APIRouter, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+import logging
 import os
-import bcrypt
+from pymongo.errors import DuplicateKeyError
 
 from ..app import db
 from .user_models import UserRegistration
+from .password_hashing import password_hasher
+from .facility_registry import facility_registry
 from .token_models import Token
 from dotenv import load_dotenv
 
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 
+logger = logging.getLogger(__name__)
+
 
 
-salt = bcrypt.gensalt()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/users/login')
 router = APIRouter()
 users_collection = db.get_collection(os.environ.get("USER_COLLECTION"))
 facilities_collection = db.get_collection(os.environ.get('FACILITIES_COLLECTION'))
 
 from ..dependencies.authenticate import create_access_token, get_current_active_user
+from ..dependencies.principal_cache import principal_cache
 
 @router.post('/users/register',
         summary="Register a new user(healthcare facility)",
@@ -54,26 +59,63 @@ async def register_user(user: UserRegistration = Body(...)):
     if await users_collection.find_one({'email': data['email']}):
         raise HTTPException(status_code=400, detail='Email/User exists')
     
-    #if facility is already registered, return an error
-    if await users_collection.find_one({'facility_name': data['facility_name']}):
-        raise HTTPException(status_code=400, detail='Facility already registered')
-    
-    # check if facility is duly registered
-    facility = await facilities_collection.find_one({'facility_name': data['facility_name']})
+    # check if facility is duly registered, from memory once the registry is loaded
+    if facility_registry.loaded:
+        facility = facility_registry.get(data['facility_name'])
+        facility = facility._asdict() if facility else None
+    else:
+        facility = await facilities_collection.find_one({'facility_name': data['facility_name']})
     if not facility:
-        raise HTTPException(status_code=400, detail='Facility is not registered to offer services')
+        detail = 'Facility is not registered to offer services'
+        suggestions = facility_registry.suggest(data['facility_name'], limit=3)
+        if suggestions:
+            names = '; '.join(f'"{match.facility_name}"' for match, _ in suggestions)
+            detail += f'. Did you mean: {names}'
+        raise HTTPException(status_code=400, detail=detail)
     if facility['status'] != 'Active':
         raise HTTPException(status_code=400, detail='Facility license is revoked')
+    # store the name exactly as the regulator lists it
+    data['facility_name'] = facility['facility_name']
+
+    #if facility is already registered, return an error
+    if await users_collection.find_one({'facility_name': data['facility_name']}):
+        raise HTTPException(status_code=400, detail='Facility already registered')
     
     #save the user to the database
-    hash_pd = bcrypt.hashpw(data['password'].encode('utf-8'), salt)
-    data['password'] = hash_pd.decode('utf-8')
+    data['password'] = await password_hasher.hash(data['password'])
     data['facility_type'] = facility['facility_type']
-    user = await users_collection.insert_one(data)
-    print('new user created')
+    try:
+        user = await users_collection.insert_one(data)
+    except DuplicateKeyError as e:
+        # a concurrent registration got past the checks above first
+        if 'email' in (e.details or {}).get('keyPattern', {}):
+            raise HTTPException(status_code=400, detail='Email/User exists')
+        raise HTTPException(status_code=400, detail='Facility already registered')
+    principal_cache.invalidate_user(data['email'])
+    logger.info("new user created", extra={'facility_name': data['facility_name']})
     return {'status': 'user_created'}
     
 
+@router.get('/users/facilities/suggest',
+    summary="Find registered facility names similar to a given name")
+async def suggest_facilities(
+        name: Annotated[str, Query(min_length=3)],
+        limit: Annotated[int, Query(gt=0, le=20)] = 5,):
+    """Look up facility names as registered by the regulatory body (PPB for now)
+        that resemble the name supplied. Matching ignores case, spacing and
+        punctuation, so this can be used to find the exact facility_name to
+        register with.
+
+    Returns:
+
+        (JSON) {"suggestions": ARRAY of {facility_name, facility_type, status, score}}
+            best match first, score between 0 and 1
+    """
+    return {'suggestions': [
+        {**match._asdict(), 'score': score}
+        for match, score in facility_registry.suggest(name, limit)]}
+
+
 @router.post('/users/login', response_model=Token,
     summary="Log in user and generate access token")
 async def login_user(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
@@ -101,9 +143,7 @@ async def login_user(form_data: Annotated[OAuth2PasswordRequestForm, Depends()])
         headers={"WWW-Authenticate": "Bearer"},
         )
     
-    fm_pwd_bytes = form_data.password.encode('utf-8')
-    ur_pwd_bytes = user['password'].encode('utf-8')
-    if not bcrypt.checkpw(fm_pwd_bytes, ur_pwd_bytes):
+    if not await password_hasher.verify(form_data.password, user['password']):
         raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Incorrect password",
@@ -111,5 +151,5 @@ async def login_user(form_data: Annotated[OAuth2PasswordRequestForm, Depends()])
     )
 
     access_token = create_access_token(data={'sub': user['email']})
-    print('user logged in')
+    logger.info("user logged in", extra={'facility_name': user.get('facility_name')})
     return Token(access_token=access_token, token_type="bearer")                       
@@ -0,0 +1,57 @@
+import asyncio
+import os
+
+import pytest
+
+# the app reads its settings when api.app is imported, so point it at a
+# scratch database first; this database is dropped before and after the run
+os.environ['MONGO_URI'] = os.environ.get('TEST_MONGO_URI', 'mongodb://localhost:27017')
+os.environ['DATABASE'] = os.environ.get('TEST_DATABASE', 'patientconnect_test')
+os.environ.setdefault('PATIENT_COLLECTION', 'patients')
+os.environ.setdefault('USER_COLLECTION', 'users')
+os.environ.setdefault('FACILITIES_COLLECTION', 'facilities')
+os.environ.setdefault('SECRET_KEY', 'test-secret')
+os.environ.setdefault('ALGORITHM', 'HS256')
+os.environ.setdefault('MONGO_SERVER_SELECTION_TIMEOUT_MS', '2000')
+
+
+@pytest.fixture(scope='session')
+def run():
+    """Run a coroutine on the session's event loop; Motor binds the client
+    to the first loop it is used from, so every test shares one. It is also
+    the current loop, because Motor creates its futures on that one."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop.run_until_complete
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture(scope='session')
+def app(run):
+    """The app against an empty database with the production indexes"""
+    from pymongo.errors import PyMongoError
+
+    from api.app import app, client, db
+    from api.indexes import ensure_indexes
+    try:
+        run(client.admin.command('ping'))
+    except PyMongoError as e:
+        pytest.skip(f"no mongod at {os.environ['MONGO_URI']}: {e}")
+    run(client.drop_database(db.name))
+    run(ensure_indexes(db))
+    yield app
+    run(client.drop_database(db.name))
+
+
+@pytest.fixture
+def facility_user(app):
+    """Authenticate every request as a user of a test facility"""
+    from api.dependencies.authenticate import get_current_active_user
+    from api.users.user_models import User
+
+    user = User(email='clinic@example.com', facility_name='Test Clinic',
+                facility_type='Medical Clinic')
+    app.dependency_overrides[get_current_active_user] = lambda: user
+    yield user
+    app.dependency_overrides.pop(get_current_active_user, None)
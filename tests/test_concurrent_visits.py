@@ -0,0 +1,88 @@
+"""Many coroutines posting visits for the same id_number at once must not
+register the patient (or a dependent) twice, nor lose any visit."""
+import asyncio
+import copy
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+
+CONCURRENCY = 50
+
+
+def visit_upload(id_number: int, name: str, parent_name: str | None = None) -> dict:
+    from api.patients.patient_models import VisitDetails
+
+    visit_details = copy.deepcopy(VisitDetails.model_config['json_schema_extra']['example'])
+    visit_details['patient_bio']['name'] = name
+    return {
+        'patient_search': {
+            'id_number': id_number,
+            'name': name,
+            'is_child': parent_name is not None,
+            'parent_name': parent_name,
+        },
+        'visit_details': visit_details,
+    }
+
+
+async def post_all(app, uploads: list[dict]) -> list:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://test') as http:
+        return await asyncio.gather(*(http.post('/patients/visit', json=upload) for upload in uploads))
+
+
+async def stored(id_number: int) -> list[dict]:
+    from api.patients.patient_routes import patients_collection
+
+    return await patients_collection.find({'id_number': id_number}).to_list(None)
+
+
+async def visit_count(id_number: int, child_name: str | None = None) -> int:
+    from api.patients.visit_store import visits_collection, patient_key
+
+    return await visits_collection.count_documents(
+        {'patient_key': patient_key(id_number, child_name)})
+
+
+def test_adult_registered_once(run, app, facility_user):
+    id_number = 10000001
+    responses = run(post_all(app, [visit_upload(id_number, 'John Doe')] * CONCURRENCY))
+
+    assert [response.status_code for response in responses] == [201] * CONCURRENCY
+    patients = run(stored(id_number))
+    assert len(patients) == 1
+    assert run(visit_count(id_number)) == CONCURRENCY
+    # one version bump per visit, none lost to a race
+    assert patients[0]['version'] == CONCURRENCY
+
+
+def test_dependent_registered_once(run, app, facility_user):
+    id_number = 10000002
+    # the same child, spelled the way different facilities might
+    uploads = [visit_upload(id_number, name, parent_name='Mary Doe')
+               for name in ['Jane Doe', 'doe jane'] * (CONCURRENCY // 2)]
+    responses = run(post_all(app, uploads))
+
+    assert [response.status_code for response in responses] == [201] * CONCURRENCY
+    patients = run(stored(id_number))
+    assert len(patients) == 1
+    assert patients[0]['name'] == 'Mary Doe'
+    assert [child['name_key'] for child in patients[0]['dependents']] == ['doe jane']
+    assert patients[0]['dependents'][0]['version'] == CONCURRENCY
+    assert run(visit_count(id_number, 'Jane Doe')) == CONCURRENCY
+
+
+def test_siblings_all_kept(run, app, facility_user):
+    id_number = 10000003
+    children = ['Amos Doe', 'Ruth Doe']
+    uploads = [visit_upload(id_number, name, parent_name='Mary Doe')
+               for name in children * (CONCURRENCY // 2)]
+    responses = run(post_all(app, uploads))
+
+    assert [response.status_code for response in responses] == [201] * CONCURRENCY
+    patients = run(stored(id_number))
+    assert len(patients) == 1
+    assert sorted(child['name_key'] for child in patients[0]['dependents']) == ['amos doe', 'doe ruth']
+    for name in children:
+        assert run(visit_count(id_number, name)) == CONCURRENCY // 2